@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# ====================
+#       Set-up
+# ====================
+
+# Import required modules
+import random
+from samiTools.marc_data import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#   Global variables
+# ====================
+
+
+ARGUMENTS = OrderedDict([
+    ('-o', 'path to FOLDER to contain the generated files'),
+])
+
+OPTIONS = OrderedDict([
+    ('--size', 'Size of each generated file in MB (default 10)'),
+    ('--formats', 'Formats to generate: authorities, txt, prn, xml (default all)'),
+    ('--seed', 'Seed for the random number generator (default 1)'),
+])
+
+FLAGS = OrderedDict([
+    ('--help', 'Display help message and exit'),
+])
+
+# Name of the generated file for each format
+FILENAMES = OrderedDict([
+    ('authorities', 'authorities.txt'),
+    ('txt', 'products_export_ALL'),
+    ('prn', 'products.prn'),
+    ('xml', 'products_oai.xml'),
+])
+
+# Words from which titles, names and notes are made; some are not ASCII, and some must be escaped in XML
+WORDS = ['sonata', 'fireworks', 'quartet', 'symphony', 'concerto', 'suite', 'overture', 'live', 'session', 'recording',
+         'jazz', 'songs', 'night', 'river', 'garden', 'Handel', 'Corea', 'Wright', 'Müller', 'Björk', 'Dvořák',
+         'Šostakovič', 'Żeleński', 'Jürgen', 'Ærø', 'Ελληνικά', 'Чайковский', '東京', 'Montréal', 'São Paulo',
+         'A & B', '"quoted"', "it's", '<x>']
+SURNAMES = ['Wright', 'Corea', 'Handel', 'Müller', 'Björk', 'Dvořák', 'Collier', 'Davis', 'Ó Riada', 'Nørgård',
+            'Szymanowski', 'Ligeti', 'Chaminade', 'Dupré', 'Ibáñez', 'Çelik']
+FORENAMES = ['David', 'Chick', 'George Frideric', 'Anna', 'Antonín', 'Seán', 'Per', 'Karol', 'György', 'Cécile',
+             'Marcel', 'José', 'Ayşe']
+FORMS = ['WORK', 'DOCREC', 'PUBLPROD', 'MLRECITEM', 'WRSECITEM', 'DOCRECITEM']
+ROLES = ['(performer)', '(composer)', '(arranger)', '(conductor)', '(speaker)', '(interviewer)']
+LIBRARIES = ['RECORDING', 'WORKS-FILE', 'RECORDED', 'DOCUMENT']
+LOCATIONS = ['STORE', 'STORE+E', 'STACKS', 'OFFSITE']
+CATEGORIES = ['POP', 'CLASSICAL', 'JAZZ', 'WORLD', 'DRAMA', 'ORCH & CH']
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def usage(extended=False):
+    """Function to print information about the program"""
+    print('\nCorrect syntax is:\n')
+    print('generate_corpus -o <output_path> [--size <MB>] [--formats <formats>] [--seed <number>]')
+    print('\nArguments:')
+    for o in ARGUMENTS:
+        print_opt(o, ARGUMENTS[o])
+    print('\nOptions:')
+    for o in OPTIONS:
+        print_opt(o, OPTIONS[o])
+    print('\nFlags:')
+    for o in FLAGS:
+        print_opt(o, FLAGS[o])
+    if extended:
+        print("""\
+
+One file of (at least) the specified size is generated for each format:
+    authorities.txt       SAMI Authorities text, with continuation lines
+    products_export_ALL   SAMI Products text
+    products.prn          SAMI Products .prn
+    products_oai.xml      SAMI Products OAI-PMH XML
+Products records have holdings with several items, as 999 fields in
+text files and as <call> and <item> elements in .prn files;
+Text in all files includes non-ASCII characters, and characters
+which must be escaped in XML;
+The same seed always generates the same files.\
+    """)
+    exit_prompt()
+
+
+def phrase(rng, least, most):
+    """Function to return between least and most random words"""
+    return ' '.join(rng.choice(WORDS) for i in range(rng.randint(least, most)))
+
+
+def name(rng):
+    """Function to return a random personal name, inverted"""
+    return '{}, {}'.format(rng.choice(SURNAMES), rng.choice(FORENAMES))
+
+
+def sami_date(rng):
+    """Function to return a random date in the form used by SAMI (d/m/yyyy)"""
+    return '{}/{}/{}'.format(rng.randint(1, 28), rng.randint(1, 12), rng.randint(1990, 2019))
+
+
+def authority_record(rng, n):
+    """Function to return the text of a SAMI Authorities record"""
+    header = ['XX{}'.format(n).ljust(16), rng.choice(['NAME', 'SUBJECT', 'TITLE']), rng.choice(['AUTHORIZED', 'UNAUTHORIZED']),
+              sami_date(rng), 'JCOLLIER  ', sami_date(rng), 'IDAVIS    ', rng.choice([sami_date(rng), 'NEVER']),
+              rng.choice(['LOCAL', 'SRC', ''])]
+    lines = ['\t\t'.join(header) + '\t\t', '  000:   |az n  n a', '  008:   |a161109   a    aaa']
+    if rng.random() < 0.5: lines.append('  001:   |aXX{}'.format(n))
+    lines.append('  100:   |a{},|b{}-'.format(name(rng), rng.randint(1900, 1990)))
+    for i in range(rng.randint(0, 6)):
+        lines.append('  {}:   |a{}'.format(rng.choice(['400', '500', '510']), phrase(rng, 2, 5)))
+    lines.append('  300:   |apn')
+    if rng.random() < 0.3: lines.append('  312:   |ahttp://www.example.org/{}.htm'.format(n))
+    # Long notes are wrapped onto continuation lines
+    if rng.random() < 0.5:
+        note = textwrap.wrap(phrase(rng, 10, 50), 60)
+        lines.append('  680:   |a' + note[0])
+        lines.extend('       ' + line for line in note[1:])
+    return '\n'.join(lines) + '\n\n'
+
+
+def product(rng, n):
+    """Function to return the MARC entries and holdings of a SAMI Products record
+
+    Entries are tuples (tag, label, ind, content); holdings are tuples (call_number, library, items),
+    where items is a list of dictionaries of the elements of each <item>"""
+    entries = [('000', 'Leader', '  ', '|aam  0c a'), ('001', 'Record control no.', '  ', '|aCKEY{}'.format(n)),
+               ('245', 'Item title', '10', '|a{}|b{}'.format(phrase(rng, 1, 6), phrase(rng, 1, 4))),
+               ('260', 'Publication', '  ', '|c{}'.format(rng.randint(1950, 2019))),
+               ('596', 'Held by', '  ', '|a{}'.format(rng.randint(1, 4)))]
+    for i in range(rng.randint(0, 6)):
+        link = '|=^A{}'.format(rng.randint(1, 500000)) if rng.random() < 0.7 else '|?UNAUTHORIZED'
+        entries.append(('700', 'Contributor', '1 ', '|a{}|c{}{}'.format(name(rng), rng.choice(ROLES), link)))
+    if rng.random() < 0.5: entries.append(('500', 'Note', '  ', '|a' + phrase(rng, 5, 30)))
+    entries.append(('974', 'MD-ARK', '  ', '|aark:/81055/vdc_{:012d}.0x{:06x}'.format(n, rng.randint(0, 0xffffff))))
+    holdings, item_count = [], 0
+    for c in range(rng.randint(1, 3)):
+        library = rng.choice(LIBRARIES)
+        items = []
+        for i in range(rng.randint(1, 4)):
+            item_count += 1
+            items.append(OrderedDict([('copyNumber', str(i + 1)), ('itemID', '{}-{}'.format(n, 999 + item_count)),
+                                      ('library', library), ('location', rng.choice(LOCATIONS)),
+                                      ('homeLocation', rng.choice(LOCATIONS)), ('category1', rng.choice(CATEGORIES)),
+                                      ('type', library), ('dateCreated', '{}-{:02d}-{:02d}'.format(
+                                          rng.randint(1990, 2019), rng.randint(1, 12), rng.randint(1, 28)))]))
+        holdings.append(('C{}/{} S{}'.format(n, c, c + 1), library, items))
+    return entries, holdings
+
+
+def text_record(rng, n):
+    """Function to return the text of a SAMI Products record in text format"""
+    entries, holdings = product(rng, n)
+    lines = ['*** DOCUMENT BOUNDARY ***', 'FORM={}'.format(rng.choice(FORMS))]
+    for tag, label, ind, content in entries:
+        lines.append('.{}. {}'.format(tag, content) if tag < '010' else '.{}. {}{}'.format(tag, ind, content))
+    for call_number, library, items in holdings:
+        for item in items:
+            date = '{2}/{1}/{0}'.format(*[int(d) for d in item['dateCreated'].split('-')])
+            lines.append('.999.   |a{}|wALPHANUM|c{}|i{}|d{}|l{}|m{}|rY|sY|t{}|u{}|x{}'.format(
+                call_number, item['copyNumber'], item['itemID'], date, item['homeLocation'], library, item['type'],
+                date, item['category1']))
+    return '\n'.join(lines) + '\n'
+
+
+def prn_record(rng, n):
+    """Function to return the text of a SAMI Products record in .prn format"""
+    entries, holdings = product(rng, n)
+    lines = ['<catalog>', '    <marc>']
+    for tag, label, ind, content in entries:
+        lines.append('        <marcEntry tag="{}" label="{}" ind="{}">{}</marcEntry>'.format(
+            tag, label, ind, html.escape(content, quote=False)))
+    lines.append('    </marc>')
+    for call_number, library, items in holdings:
+        lines.extend(['    <call>', '        <callNumber>   {}</callNumber>'.format(call_number),
+                      '        <library>{}</library>'.format(library),
+                      '        <numberOfCopies>{}</numberOfCopies>'.format(len(items))])
+        for item in items:
+            lines.append('        <item>')
+            lines.extend('            <{0}>{1}</{0}>'.format(key, html.escape(value, quote=False)) for key, value in item.items())
+            lines.append('        </item>')
+        lines.append('    </call>')
+    lines.append('</catalog>')
+    return '\n'.join(lines) + '\n'
+
+
+def generate(path, reader_type, size, rng):
+    """Function to write records of the format reader_type to path until it holds at least size bytes,
+    returning the number of records written"""
+    n = 0
+    if reader_type == 'xml':
+        # XML is written as by sami2marc_products -x --header, from records in text format
+        writer = MARCXMLWriter(open(path, mode='wb'), header=True, buffer_size=WRITE_BUFFER_SIZE)
+        while writer.file_handle.tell() + len(writer.buffer) < size:
+            n += 1
+            writer.write(SAMIRecordText(text_record(rng, n)))
+        writer.close()
+        return n
+    with open(path, mode='w', encoding='utf-8', newline='\n') as file:
+        if reader_type == 'prn':
+            file.write('<?xml version="1.0" encoding="UTF-8"?>\n<report>\n<title>Catalog</title>\n'
+                       '<dateFormat>yyyy-mm-dd</dateFormat>\n<dateCreated>2018-06-01T10:11:12</dateCreated>\n')
+        record = authority_record if reader_type == 'authorities' else prn_record if reader_type == 'prn' else text_record
+        while file.tell() < size:
+            n += 1
+            file.write(record(rng, n))
+        if reader_type == 'prn': file.write('</report>\n')
+    return n
+
+
+# ====================
+#      Main code
+# ====================
+
+
+def main(argv=None):
+    if argv is None: name = str(sys.argv[1])
+
+    opts, args = None, None
+    output_path = None
+    size = 10
+    formats = list(FILENAMES)
+    seed = 1
+
+    print('========================================')
+    print('generate_corpus')
+    print('========================================')
+    print("""\
+This program generates SAMI files of random records
+for use by run_benchmarks\
+""")
+
+    try: opts, args = getopt.getopt(argv, 'ho:', ['output_path=', 'size=', 'formats=', 'seed=', 'help'])
+    except getopt.GetoptError as err:
+        exit_prompt('Error: {}'.format(err))
+    if opts is None or not opts:
+        usage()
+    for opt, arg in opts:
+        if opt in ['-h', '--help']:
+            usage(extended=True)
+        elif opt in ['-o', '--output_path']:
+            output_path = arg
+        elif opt == '--size':
+            try: size = float(arg)
+            except: size = 0
+            if not size > 0: exit_prompt('Size could not be interpreted. \n'
+                                         'Please ensure that it is a positive number.')
+        elif opt == '--formats':
+            formats = [f.strip().lower() for f in arg.split(',') if f.strip()]
+            if not formats or not set(formats) <= set(FILENAMES):
+                exit_prompt('Error: Formats could not be interpreted. \n'
+                            'Please use one or more of {}, separated by commas.'.format(', '.join(FILENAMES)))
+        elif opt == '--seed':
+            try: seed = int(arg)
+            except: exit_prompt('Seed could not be interpreted. \n'
+                                'Please ensure that it is an integer.')
+        else:
+            exit_prompt('Error: Option {} not recognised'.format(opt))
+
+    if not output_path:
+        exit_prompt('Error: No path to output files has been specified')
+    if not os.path.isdir(output_path):
+        try: os.makedirs(output_path)
+        except: exit_prompt('Error: Could not parse path to output files')
+
+    for reader_type in formats:
+        path = os.path.join(output_path, FILENAMES[reader_type])
+        date_time('Generating {} ...'.format(path))
+        # Each file has its own generator, so that a file is the same whichever other formats are generated
+        record_count = generate(path, reader_type, int(size * 1024 * 1024), random.Random('{}-{}'.format(seed, reader_type)))
+        print('{} records written ({} bytes)'.format(str(record_count), str(os.path.getsize(path))))
+
+    date_time_exit()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# ====================
+#       Set-up
+# ====================
+
+# Import required modules
+import platform
+import tempfile
+import time
+from samiTools.marc_data import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#   Global variables
+# ====================
+
+
+ARGUMENTS = OrderedDict([
+    ('-i', 'path to FOLDER containing the corpus'),
+    ('-o', 'path to Output file for the results (.json)'),
+])
+
+OPTIONS = OrderedDict([
+    ('--repeat', 'Number of times to run each benchmark (default 3)'),
+    ('--compare', 'path to the results of an earlier run to compare with'),
+])
+
+FLAGS = OrderedDict([
+    ('--help', 'Display help message and exit'),
+])
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def usage(extended=False):
+    """Function to print information about the program"""
+    print('\nCorrect syntax is:\n')
+    print('run_benchmarks -i <input_path> -o <ofile> [--repeat <number>] [--compare <file>]')
+    print('\nArguments:')
+    for o in ARGUMENTS:
+        print_opt(o, ARGUMENTS[o])
+    print('\nOptions:')
+    for o in OPTIONS:
+        print_opt(o, OPTIONS[o])
+    print('\nFlags:')
+    for o in FLAGS:
+        print_opt(o, FLAGS[o])
+    if extended:
+        print("""\
+
+The corpus is a folder of SAMI files, such as one made by generate_corpus;
+.txt files are read as SAMI Authorities, .prn and .xml files as SAMI
+Products, and files whose names end with export_ALL etc. as SAMI
+Products text. Other files are ignored.
+
+For each file, the following are timed separately:
+    <SAMIReader>.chunks   finding the records in the file
+    <SAMIRecord>.parse    parsing the records found
+    <SAMIRecord>.as_marc  converting the parsed records to MARC 21
+    <SAMIRecord>.as_xml   converting the parsed records to MARC XML
+    MARCReader.decode     reading the MARC 21 records, and decoding
+                          all of their fields
+Each benchmark is run --repeat times, and the shortest time is used;
+Speeds are reported in records per second, and in MB per second of
+the data read (or written, for as_marc and as_xml).
+
+If parameter --compare is specified:
+    For each benchmark also in the earlier results, the change in
+    speed (in records per second) is reported.\
+    """)
+    exit_prompt()
+
+
+def reader_type(file):
+    """Function to return the reader type of a file in the corpus, or None if it is not a SAMI file"""
+    if file.endswith(SAMI_SUFFICES): return 'txt'
+    return {'.txt': 'authorities', '.prn': 'prn', '.xml': 'xml'}.get(os.path.splitext(file)[1])
+
+
+def timed(function, repeat, setup=None):
+    """Function to call function repeat times, returning its last result and the shortest time taken
+
+    If setup is given, it is called (untimed) before each call, and its result is passed to function"""
+    result, best = None, None
+    for i in range(repeat):
+        args = (setup(),) if setup else ()
+        gc.collect()
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best: best = seconds
+    return result, best
+
+
+def measure(benchmark, file, records, size, seconds):
+    """Function to return the result of a benchmark as a dictionary, and print it"""
+    result = OrderedDict([('benchmark', benchmark), ('file', file), ('records', records), ('bytes', size),
+                          ('seconds', seconds), ('records_per_sec', records / seconds if seconds else None),
+                          ('mb_per_sec', size / 1024 / 1024 / seconds if seconds else None)])
+    print('{:<32}{:<24}{:>12.0f} records/s{:>10.2f} MB/s'.format(
+        benchmark, file, result['records_per_sec'] or 0, result['mb_per_sec'] or 0))
+    return result
+
+
+def decode(path):
+    """Function to read a MARC 21 file and decode all of its fields, returning the number of records"""
+    record_count = 0
+    reader = MARCReader(path)
+    for record in reader:
+        for field in record:
+            if field.is_control_field(): field.data
+            else: field.subfields
+        record_count += 1
+    reader.close()
+    return record_count
+
+
+def benchmark_file(path, reader_type, repeat, temp_path):
+    """Function to run the benchmarks for a single file in the corpus, returning a list of their results"""
+    file, results = os.path.basename(path), []
+    reader = sami_factory(reader_type, None)
+    reader_name = type(reader).__name__
+
+    def chunks():
+        file_reader = sami_factory(reader_type, path)
+        data = list(file_reader.chunks())
+        file_reader.close()
+        return data
+
+    def parse():
+        return [reader.record(data, False) for data in data_list]
+
+    data_list, seconds = timed(chunks, repeat)
+    results.append(measure('{}.chunks'.format(reader_name), file, len(data_list), os.path.getsize(path), seconds))
+    if not data_list: return results
+
+    records, seconds = timed(parse, repeat)
+    record_name = type(records[0]).__name__
+    size = sum(len(data.encode('utf-8')) for data in data_list)
+    results.append(measure('{}.parse'.format(record_name), file, len(records), size, seconds))
+
+    # Records cache their encodings, so each conversion is timed with records which have just been parsed
+    marc, seconds = timed(lambda records: [record.as_marc() for record in records], repeat, setup=parse)
+    results.append(measure('{}.as_marc'.format(record_name), file, len(marc), sum(len(m) for m in marc), seconds))
+    xml, seconds = timed(lambda records: [record.as_xml() for record in records], repeat, setup=parse)
+    results.append(measure('{}.as_xml'.format(record_name), file, len(xml), sum(len(x.encode('utf-8')) for x in xml), seconds))
+
+    marc_path = os.path.join(temp_path, file + '.lex')
+    with open(marc_path, mode='wb') as marc_file:
+        for m in marc: marc_file.write(m)
+    record_count, seconds = timed(lambda: decode(marc_path), repeat)
+    results.append(measure('MARCReader.decode', file, record_count, os.path.getsize(marc_path), seconds))
+    os.remove(marc_path)
+    return results
+
+
+def compare(results, path):
+    """Function to print the change in speed of each benchmark since the results saved in path"""
+    with open(path, mode='r', encoding='utf-8') as file:
+        earlier = dict(((r['benchmark'], r['file']), r) for r in json.load(file)['results'])
+    print('\nChange in speed since {}:'.format(path))
+    for result in results:
+        before = earlier.get((result['benchmark'], result['file']))
+        if not before or not before['records_per_sec'] or not result['records_per_sec']: continue
+        print('{:<32}{:<24}{:>+10.1f}%'.format(result['benchmark'], result['file'],
+                                                (result['records_per_sec'] / before['records_per_sec'] - 1) * 100))
+
+
+# ====================
+#      Main code
+# ====================
+
+
+def main(argv=None):
+    if argv is None: name = str(sys.argv[1])
+
+    opts, args = None, None
+    input_path, output_file, earlier = None, None, None
+    repeat = 3
+
+    print('========================================')
+    print('run_benchmarks')
+    print('========================================')
+    print("""\
+This program measures the speed of reading, parsing and
+converting the SAMI files in a corpus\
+""")
+
+    try: opts, args = getopt.getopt(argv, 'hi:o:', ['input_path=', 'ofile=', 'repeat=', 'compare=', 'help'])
+    except getopt.GetoptError as err:
+        exit_prompt('Error: {}'.format(err))
+    if opts is None or not opts:
+        usage()
+    for opt, arg in opts:
+        if opt in ['-h', '--help']:
+            usage(extended=True)
+        elif opt in ['-i', '--input_path']:
+            input_path = arg
+        elif opt in ['-o', '--ofile']:
+            output_file = arg
+        elif opt == '--compare':
+            earlier = arg
+        elif opt == '--repeat':
+            try: repeat = int(arg)
+            except: repeat = 0
+            if not repeat >= 1: exit_prompt('Number of repeats could not be interpreted. \n'
+                                            'Please ensure that it is a positive integer.')
+        else:
+            exit_prompt('Error: Option {} not recognised'.format(opt))
+
+    if not input_path:
+        exit_prompt('Error: No path to the corpus has been specified')
+    if not os.path.isdir(input_path):
+        exit_prompt('Error: Invalid path to the corpus')
+    if not output_file:
+        exit_prompt('Error: No path to output file has been specified')
+    if earlier and not os.path.isfile(earlier):
+        exit_prompt('Error: The results to compare with cannot be found')
+
+    files = sorted(file for file in os.listdir(input_path) if reader_type(file))
+    if not files:
+        exit_prompt('Error: The corpus does not contain any SAMI files')
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_path:
+        for file in files:
+            date_time('Benchmarking {} ...'.format(file))
+            results.extend(benchmark_file(os.path.join(input_path, file), reader_type(file), repeat, temp_path))
+
+    with open(output_file, mode='w', encoding='utf-8') as file:
+        json.dump(OrderedDict([('date', datetime.datetime.now().isoformat()), ('python', platform.python_version()),
+                               ('platform', platform.platform()), ('corpus', input_path), ('repeat', repeat),
+                               ('results', results)]), file, indent=2)
+    print('\nResults saved to {}'.format(output_file))
+    if earlier: compare(results, earlier)
+
+    date_time_exit()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -6,7 +6,9 @@
 # ====================
 
 # Import required modules
+from collections import deque
 from math import log10
+import multiprocessing
 from samiTools.marc_data import *
 
 # Set locale to assist with sorting
@@ -50,11 +52,29 @@ ARGUMENTS = OrderedDict([
 OPTIONS = OrderedDict([
     ('--date', 'Split output into two files by specified date'),
     ('--max_size', 'Split output by size or number of records'),
+    ('--workers', 'Number of processes to use for conversion'),
+    ('--where', 'Only convert records matching a filter expression'),
+    ('--keep-tags', 'Only keep fields with the listed tags'),
+    ('--drop-tags', 'Remove fields with the listed tags'),
+    ('--partition-by', 'Split output into files by the value of an expression'),
+    ('--delta', 'Only write records which are new or changed since the last run'),
 ])
 
+# Number of records sent to a worker process at a time
+BATCH_SIZE = 500
+
+# Number of records converted between checkpoints
+CHECKPOINT_INTERVAL = 10000
+
+# Conversion options, set in each worker process
+options = {}
+
 FLAGS = OrderedDict([
     ('--tidy', 'Tidy authority files to facilitate load to MetAg'),
     ('--header', 'Include MetAg headers in MARC XML records'),
+    ('--subdirs', 'Place individual records in hashed subdirectories'),
+    ('--checkpoint', 'Save progress so that the conversion can be resumed'),
+    ('--resume', 'Resume an interrupted conversion from its last checkpoint'),
     ('--help', 'Display help message and exit'),
 ])
 
@@ -68,8 +88,10 @@ def usage(extended=False):
     """Function to print information about the program"""
     print('\nCorrect syntax is:\n')
     print('sami2marc_authorities -i <ifile> -o <ofile>'
-          '\n\t\t\t[--date <yyyymmdd>|--max_size <number|size>]'
-          '\n\t\t\t[--tidy] [--header]')
+          '\n\t\t\t[--date <yyyymmdd>|--max_size <number|size>|--partition-by <expression>]'
+          '\n\t\t\t[--workers <number>] [--where <expression>]'
+          '\n\t\t\t[--keep-tags <tags>] [--drop-tags <tags>] [--delta <store>]'
+          '\n\t\t\t[--tidy] [--header] [--subdirs] [--checkpoint|--resume]')
     print('\nArguments:')
     for o in ARGUMENTS:
         print_opt(o, ARGUMENTS[o])
@@ -78,13 +100,15 @@ def usage(extended=False):
 Use quotation marks (") around arguments which contain spaces
 Input file should be SAMI Authorities files in .xml, .prn or text format
 Output file should be either MARC exchange (.lex) or MARC XML (.xml)
+Files with the further extension .gz, .bz2 or .xz (e.g. .lex.gz) will be 
+read or written with gzip, bzip2 or xz compression
 Records with errors will be written to <ofile>_errors.\
 
 """)
     print('Options:')
     for o in OPTIONS:
         print_opt(o, OPTIONS[o])
-    print('--date and --max_size cannot be used at the same time.')
+    print('--date, --max_size and --partition-by cannot be used at the same time.')
     print('\nFlags:')
     for o in FLAGS:
         print_opt(o, FLAGS[o])
@@ -99,7 +123,9 @@ If parameter --date is specified:
     
 If parameter --max_size is specified:
     max_size is EITHER the maximum number of records in an output file 
-    OR the (approx) maximum file size (in KB) if the number has the suffix 'K';
+    OR the maximum file size (in KB) if the number has the suffix 'K';
+    a file will only be larger than this if it contains a single record 
+    which is larger;
     Output will be written to a sequence of files with the same name as the 
     input file, but with a suffix indicating its order in the generated 
     output sequence
@@ -107,7 +133,52 @@ If parameter --max_size is specified:
     individual records) in which case the output files will be labelled with 
     the record identifier;
     Records with duplicate identifiers will be labelled with _DUPLICATE;
-    Records without identifiers will be labelled with _NO IDENTIFIER.
+    Records without identifiers will be labelled with _NO IDENTIFIER;
+    If --subdirs is also specified, the files will be placed in 
+    subdirectories (such as ab/cd/) named from a hash of their labels.
+    
+If parameter --workers is specified:
+    Records will be parsed and converted by the specified number of 
+    processes running in parallel;
+    Output is identical to that produced by a single process.
+
+If parameter --where is specified:
+    Only records matching the expression will be converted; records are 
+    tested before they are parsed, so records which do not match cost 
+    little time;
+    The expression is one or more terms separated by &, all of which 
+    must match:
+        TAG         the record has a field with tag TAG, e.g. 596
+        KEY=VALUE   a column of the record header has the value VALUE; 
+                    alternative values may be separated by |
+    KEY is one of id, fmt, level, created, created_by, modified, 
+    modified_by, cataloged or source; values are given without padding,
+    and dates as in the input, as d/m/yyyy (e.g. 9/11/2016, not 09/11/2016);
+    Any term may be negated by prefixing it with !;
+    --where may be given more than once, in which case all of the 
+    expressions must match;
+    e.g. --where "level=AUTHORIZED & !596".
+
+If parameter --keep-tags or --drop-tags is specified:
+    With --keep-tags, only fields with the listed tags will be kept; 
+    with --drop-tags, fields with the listed tags will be removed; 
+    fields which are not wanted are skipped before they are parsed;
+    Tags are separated by commas, and X matches any character, 
+    e.g. --keep-tags 001,1XX,245,999;
+    Records from which the 001 is removed have no identifier.
+
+If parameter --partition-by is specified:
+    Records will be written to a separate output file for each value of 
+    the expression, named <ofile>_<value>; records with no value will be 
+    written to <ofile>_NO VALUE; if values differ only in case, or a 
+    value is errors, _2, _3, etc. is added to the names of their files;
+    The expression is NAME[$CODE][:year], where NAME is a tag, or a 
+    column of the record header (id, fmt, level, created, created_by, 
+    modified, modified_by, cataloged or source), in any case;
+    For a tag, the value of the first field with the tag is used, or the 
+    value of its first subfield CODE (by default, its first subfield);
+    With :year, only the first 4-digit year in the value is used;
+    e.g. --partition-by fmt, or --partition-by created:year.
     
 If parameter --tidy is specified:
     If no 001 is present, one will be created from the first 901 $a;
@@ -115,6 +186,26 @@ If parameter --tidy is specified:
     906 $a and 907 $a will be combined into a single 906 field ($a and $b);
     Created and Amended date will be converted from dd/mm/yy to yyyymmdd format.
     
+If parameter --delta is specified:
+    A hash of each record written is kept, by identifier, in the SQLite 
+    database <store>, which is created if it does not exist;
+    Only records which are new, or which have changed since the last run 
+    with the same store, will be written;
+    Records in the store which are no longer in the input will be written 
+    to <ofile>_deleted as deletions (with a deleted <header> if --header 
+    is specified, or otherwise with record status d);
+    The store is only updated once the conversion is complete;
+    NOTE: --delta cannot be used with --where or --checkpoint.
+
+If parameter --checkpoint is specified:
+    Progress will be saved to <ofile>.checkpoint every 10000 records; 
+    the file will be removed once the conversion is complete;
+    If the conversion is interrupted, the same command with --resume in 
+    place of --checkpoint will remove anything written to the output files 
+    since the last checkpoint, and continue the conversion from there;
+    NOTE: --checkpoint cannot be used with --max_size 1, --partition-by, 
+    or compressed output.
+
 If parameter --header is specified:
     MARC XML records will be given a <header> to make them suitable for the 
     Metadata Aggregator;
@@ -124,6 +215,90 @@ If parameter --header is specified:
     exit_prompt()
 
 
+def init_worker(worker_options):
+    """Function to set the conversion options within a worker process"""
+    options.update(worker_options)
+    options['reader'] = sami_factory(reader_type=options['reader_type'], target=None, tidy=options['tidy'], tags=options['tags'])
+    # Deleted records are written with their <metadata>
+    options['writer'] = MARCXMLWriter(None, header=options['header'], single=options['split'], deleted_metadata=True)
+
+
+def convert_record(record):
+    """Function to convert a record into the data to be written for it
+
+    Returns a tuple (identifier, bad, route, data), where route is the name of the date-split file
+    for the record (or 'error' if its dates could not be parsed) or the value by which output is partitioned,
+    and data is the record encoded as bytes"""
+    date = options['date']
+    # Records are encoded once, and the same bytes are measured and written
+    data = options['writer'].encode(options['writer'].record_xml(record)) if options['xml'] else record.as_marc()
+    if options['split']: return record.identifier(), False, None, data
+    # Records without an 001 are identified for --delta by the identifier in their header
+    identifier = (record.identifier() or clean_text(record.value('id'))) if options['delta'] else None
+
+    route = None
+    if options['partition']: route = options['partition'].value(record) or 'NO VALUE'
+    elif date and not record.is_bad():
+        # Dates are compared as integer keys
+        key, fmt = options['date_key'], '%Y%m%d' if options['tidy'] else '%d/%m/%Y'
+        try:
+            route = 'post' if (record.created != 'NEVER' and parse_date(record.created, fmt)[1] >= key) \
+                              or (record.modified != 'NEVER' and parse_date(record.modified, fmt)[1] >= key) else 'pre'
+        # Records read from XML have no header dates
+        except (ValueError, AttributeError): route = 'error'
+    return identifier, record.is_bad(), route, data
+
+
+def delta_records(records, store):
+    """Generator yielding only the converted records which are new or have changed since the last run, as for --delta"""
+    for result, position in records:
+        identifier, bad, route, data = result
+        if identifier:
+            # Records with errors are not written to the main output, but have not been deleted
+            if bad: store.seen(identifier)
+            elif not store.changed(identifier, data): continue
+        yield result, position
+
+
+def reader_position(reader):
+    """Function to return the byte offset reached by a reader, and the number of records it has skipped"""
+    return reader.offset, reader.skipped
+
+
+def convert_batch(chunks):
+    """Function to parse and convert a batch of records within a worker process"""
+    return [convert_record(options['reader'].record(data=chunk, tidy=options['tidy'])) for chunk in chunks]
+
+
+def convert_parallel(reader, workers, worker_options):
+    """Function to convert records using a pool of worker processes
+
+    The input is read in batches of records, and converted records are returned in input order,
+    each with the position of the reader after the record was read"""
+    pool = multiprocessing.Pool(workers, init_worker, (worker_options,))
+    pending = deque()
+    try:
+        batch, positions = [], []
+        for chunk in reader.selected_chunks():
+            batch.append(chunk)
+            positions.append(reader_position(reader))
+            if len(batch) < BATCH_SIZE: continue
+            pending.append((pool.apply_async(convert_batch, (batch,)), positions))
+            batch, positions = [], []
+            # Limit the number of batches held in memory
+            if len(pending) > 2 * workers:
+                result, positions_done = pending.popleft()
+                yield from zip(result.get(), positions_done)
+        if batch: pending.append((pool.apply_async(convert_batch, (batch,)), positions))
+        while pending:
+            result, positions_done = pending.popleft()
+            yield from zip(result.get(), positions_done)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 # ====================
 #      Main code
 # ====================
@@ -132,9 +307,15 @@ If parameter --header is specified:
 def main(argv=None):
     if argv is None: name = str(sys.argv[1])
 
-    xml, tidy, split, header = False, False, False, False
+    xml, tidy, split, header, subdirs = False, False, False, False, False
+    checkpoint, resume = False, False
     opts, args, date, limit = None, None, None, None
     max_size = 1024 * 1024 * 1024
+    workers = 1
+    where = []
+    keep_tags, drop_tags, tags = [], [], None
+    partition = None
+    delta = None
 
     print('========================================')
     print('sami2marc_authorities')
@@ -144,7 +325,7 @@ This program converts SAMI AUTHORITY files from text, .prn, or XML format
 to MARC 21 Authority files in MARC exchange (.lex) or MARC XML format\
 """)
 
-    try: opts, args = getopt.getopt(argv, 'hi:o:m:d:t', ['ifile=', 'ofile=', 'max_size=', 'header', 'date=', 'tidy', 'help'])
+    try: opts, args = getopt.getopt(argv, 'hi:o:m:d:t', ['ifile=', 'ofile=', 'max_size=', 'header', 'date=', 'tidy', 'workers=', 'where=', 'keep-tags=', 'drop-tags=', 'partition-by=', 'delta=', 'subdirs', 'checkpoint', 'resume', 'help'])
     except getopt.GetoptError as err:
         exit_prompt('Error: {}'.format(err))
     if opts is None or not opts:
@@ -156,6 +337,12 @@ to MARC 21 Authority files in MARC exchange (.lex) or MARC XML format\
             header = True
         elif opt in ['-t', '--tidy']:
             tidy = True
+        elif opt == '--subdirs':
+            subdirs = True
+        elif opt == '--checkpoint':
+            checkpoint = True
+        elif opt == '--resume':
+            checkpoint, resume = True, True
         elif opt in ['-d', '--date']:
             date = arg
         elif opt in roles:
@@ -171,10 +358,35 @@ to MARC 21 Authority files in MARC exchange (.lex) or MARC XML format\
                                               'Please ensure that it is a positive integer, \n'
                                               'optionally followed by the suffix K.')
             if limit == 'size': max_size *= 1024
+        elif opt == '--where':
+            where.append(arg)
+        elif opt == '--partition-by':
+            try: partition = PartitionKey(arg, keys=SAMIReaderAuthorities.keys)
+            except FilterError as err: exit_prompt('Error: {}'.format(err))
+        elif opt == '--delta':
+            delta = arg
+        elif opt == '--keep-tags':
+            keep_tags.extend(arg.split(','))
+        elif opt == '--drop-tags':
+            drop_tags.extend(arg.split(','))
+        elif opt == '--workers':
+            try: workers = int(arg)
+            except: workers = 0
+            if not workers >= 1: exit_prompt('Number of workers could not be interpreted. \n'
+                                             'Please ensure that it is a positive integer.')
         else:
             exit_prompt('Error: Option {} not recognised'.format(opt))
 
     if date and limit: exit_prompt('Error: Options --date and --max_size cannot be used at the same time')
+    if partition and (date or limit): exit_prompt('Error: Option --partition-by cannot be used with --date or --max_size')
+
+    if where:
+        try: where = RecordFilter(' & '.join(where))
+        except FilterError as err: exit_prompt('Error: {}'.format(err))
+
+    if keep_tags or drop_tags:
+        try: tags = TagFilter(keep=keep_tags, drop=drop_tags)
+        except FilterError as err: exit_prompt('Error: Tags could not be interpreted: {}'.format(err.args[0]))
 
     for f in ['input', 'output']:
         if not files[f]:
@@ -209,11 +421,23 @@ to MARC 21 Authority files in MARC exchange (.lex) or MARC XML format\
         if max_size == 1:
             split = True
             print('Output file will be split into individual records')
+            if subdirs: print('Records will be placed in hashed subdirectories')
         else: print('Maximum file size : {} {}'.format(str(max_size), 'bytes' if limit == 'size' else 'records'))
     if date:
         print('\nDate for splitting output: {}'.format(date.strftime('%Y%m%d')))
     if tidy: print('Output will be tidied for MetAg use.\n')
     if header: print('MetAg headers will be used')
+    if workers > 1: print('Conversion will use {} worker processes'.format(str(workers)))
+    if where: print('Only records matching the filter expression will be converted')
+    if tags: print('Only fields with the selected tags will be converted')
+    if subdirs and not split: exit_prompt('Error: Option --subdirs can only be used with --max_size 1')
+    if partition: print('Output will be split into files by the value of the expression')
+    if checkpoint and (split or partition or files['output'].compression):
+        exit_prompt('Error: Option --checkpoint cannot be used with --max_size 1, --partition-by or compressed output')
+    if delta and (where or checkpoint): exit_prompt('Error: Option --delta cannot be used with --where or --checkpoint')
+    if delta: print('Only records which are new or changed will be written')
+    if resume: print('Conversion will be resumed from the last checkpoint')
+    elif checkpoint: print('Progress will be saved so that the conversion can be resumed')
 
     # --------------------
     # Iterate through input files
@@ -223,136 +447,180 @@ to MARC 21 Authority files in MARC exchange (.lex) or MARC XML format\
     print('----------------------------------------')
     print(str(datetime.datetime.now()))
 
-    ifile = open(files['input'].path, mode='r', encoding='utf-8', errors='replace')
-    reader = sami_factory(reader_type='xml' if files['input'].ext == '.xml' else 'authorities', target=ifile, tidy=tidy)
-    output_path, root = os.path.split(files['output'].path)
+    ifile = open_compressed(files['input'].path, mode='r', encoding='utf-8', errors='replace')
+    reader_type = 'xml' if files['input'].ext == '.xml' else 'authorities'
+    reader = sami_factory(reader_type=reader_type, target=ifile, tidy=tidy, where=where or None, tags=tags)
+    if where and not where.keys() <= set(reader.keys):
+        exit_prompt('Error: Filter expression cannot test {} in this input file'.format(', '.join(sorted(where.keys() - set(reader.keys)))))
+
+    # A checkpoint can only be resumed by a conversion with the same options
+    state, arguments = None, [a for a in argv if a not in ('--checkpoint', '--resume')]
+    if checkpoint:
+        checkpoint = Checkpoint(files['output'].path + '.checkpoint')
+    if resume:
+        try: state = checkpoint.load()
+        except (OSError, ValueError, KeyError): exit_prompt('Error: No checkpoint could be read from {}'.format(checkpoint.path))
+        if state['arguments'] != arguments: exit_prompt('Error: The checkpoint was saved by a conversion with different options')
+        reader.seek(state['offset'])
+        reader.skipped = state['skipped']
+        print('Resuming after {} records'.format(str(state['records'])))
+    output_path = files['output'].folder
     if not os.path.isdir(output_path):
         try: os.makedirs(output_path)
         except: exit_prompt('Error: Could not parse path to output file')
-    root, ext = os.path.splitext(root)
-
-    OPEN = OAI_HEADER if header else XML_HEADER
-    CLOSE = '\n</ListRecords>\n</OAI-PMH>' if header else '\n</marc:collection>'
+    root, ext = files['output'].filename, files['output'].ext + files['output'].compression
+
+    worker_options = {'reader_type': reader_type, 'tidy': tidy, 'xml': xml, 'header': header, 'date': date,
+                      'date_key': parse_date(date.strftime('%Y%m%d'), '%Y%m%d')[1] if date else None, 'split': split,
+                      'tags': tags, 'partition': partition, 'delta': bool(delta)}
+    init_worker(worker_options)
+    if workers > 1: records = convert_parallel(reader, workers, worker_options)
+    else: records = ((convert_record(record), reader_position(reader)) for record in reader)
+    store = None
+    if delta:
+        try: store = RecordStore(delta)
+        except sqlite3.Error as err: exit_prompt('Error: The store {} could not be opened: {}'.format(delta, err))
+        records = delta_records(records, store)
+    current_file = None
 
     # Special case if file is to be split into separate records
     if split:
         record_count = 0
 
-        for record in reader:
+        splitter = SplitWriter(output_path, ext, subdirs=subdirs)
+
+        for (identifier, bad, route, data), position in records:
             record_count += 1
             if record_count % 100 == 0:
                 print('{} records processed'.format(str(record_count)), end='\r')
-            filename = os.path.join(output_path, (record.identifier() or '_NO IDENTIFIER {}'.format(str(record_count))) + ext)
-            file_count = 0
-            while os.path.isfile(filename):
-                file_count += 1
-                filename = os.path.join(output_path, (record.identifier() or '_NO IDENTIFIER {}'.format(str(record_count))) + '_DUPLICATE {}'.format(str(file_count)) + ext)
-            if xml:
-                current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-                if header:
-                    current_file.write('{}{}<metadata>{}\n</metadata>\n</record>'.format(METAG_HEADER, record.header(), record.as_xml(namespace=True)))
-                else:
-                    current_file.write('{}{}\n</marc:collection>'.format(XML_HEADER, record.as_xml()))
-            else:
-                current_file = open(filename, mode='wb')
-                writer = MARCWriter(current_file)
-                writer.write(record)
+            splitter.write(identifier, record_count, data)
+        splitter.close()
+
+    # Special case if output is partitioned between files by the value of an expression
+    elif partition:
+        record_count = 0
+        # Records with errors are written to <ofile>_errors, so no partition may use that name
+        names = PartitionNames(reserved=['errors'])
+
+        def open_partition(key, append):
+            filename = os.path.join(output_path, '{}_{}{}'.format(root, names.get(key), ext))
+            # Compressed XML files cannot be reopened within their collections, so records are added in a new compressed stream,
+            # and the collections are closed when the pool is closed
+            if xml and files['output'].compression:
+                return MARCXMLWriter(open_compressed(filename, mode='ab' if append else 'wb'), header=header, resume=append,
+                                     buffer_size=WRITE_BUFFER_SIZE, open_ended=True)
+            if xml: return MARCXMLWriter(open_compressed(filename, mode='r+b' if append else 'wb'), header=header, append=append,
+                                         buffer_size=WRITE_BUFFER_SIZE)
+            return MARCWriter(open_compressed(filename, mode='ab' if append else 'wb'), buffer_size=WRITE_BUFFER_SIZE)
+
+        pool = WriterPool(open_partition, reopen=bool(xml and files['output'].compression))
+        files['errors'].file_object = MARCXMLWriter(open_compressed(files['errors'].path, mode='wb'), header=header, buffer_size=WRITE_BUFFER_SIZE) if xml \
+            else MARCWriter(open_compressed(files['errors'].path, mode='wb'), buffer_size=WRITE_BUFFER_SIZE)
+
+        for (identifier, bad, route, data), position in records:
+            record_count += 1
+            if record_count % 100 == 0:
+                print('{} records processed'.format(str(record_count)), end='\r')
+            if bad: files['errors'].file_object.write_bytes(data)
+            else: pool.get(route).write_bytes(data)
+
+        pool.close()
+        print('\nRecords written to {} files'.format(str(len(pool.keys))))
 
     # All other cases
     else:
         FMT = None
-        record_count, record_count_in_file = 0, 0
-        current_idx, current_size = 0, 0
+        record_count = state['records'] if state else 0
 
         if limit == 'size':
             FMT = ".%%0%dd" % (int(log10(os.path.getsize(files['input'].path) / max_size)) + 1)
 
-        mid = FMT % current_idx if limit == 'size' else '.{}'.format(str(current_idx)) if limit == 'number' else ''
-        filename = os.path.join(output_path, root + mid + ext)
+        def output_name(index):
+            mid = FMT % index if limit == 'size' else '.{}'.format(str(index)) if limit == 'number' else ''
+            return os.path.join(output_path, root + mid + ext)
+
+        def open_output(filename, resume=False):
+            # When resuming, records are added to the end of a file truncated to the last checkpoint
+            if resume:
+                file = open(filename, mode='r+b')
+                file.seek(0, io.SEEK_END)
+            else: file = open_compressed(filename, mode='wb')
+            if xml: return MARCXMLWriter(file, header=header, resume=resume, buffer_size=WRITE_BUFFER_SIZE)
+            return MARCWriter(file, buffer_size=WRITE_BUFFER_SIZE)
+
+        def open_file(index, resume=False):
+            return open_output(output_name(index), resume=resume)
 
         for f in files:
             if f not in ('input', 'output') and files[f]:
-                if xml:
-                    files[f].file_object = open(files[f].path, mode='w', encoding='utf-8', errors='replace')
-                    files[f].file_object.write(OPEN)
-                else:
-                    files[f].file_object = open(files[f].path, mode='wb')
-                    files[f].file_writer = MARCWriter(files[f].file_object)
-
-        if xml:
-            current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-            current_file.write(OPEN)
-        else:
-            current_file = open(filename, mode='wb')
-            writer = MARCWriter(current_file)
-
-        for record in reader:
+                files[f].file_object = open_output(files[f].path, resume=state is not None)
+
+        # Output is split into a new file before a file would exceed the maximum size or number of records
+        current_file = SequenceWriter(open_file, max_size=max_size if limit == 'size' else None,
+                                      max_records=max_size if limit == 'number' else None,
+                                      state=state['sequence'] if state else None)
+
+        def save_checkpoint(position):
+            writers = {output_name(current_file.index): current_file.writer}
+            writers.update((files[f].path, files[f].file_object) for f in ('errors', 'pre', 'post') if files[f])
+            checkpoint.save({'arguments': arguments, 'offset': position[0], 'skipped': position[1], 'records': record_count,
+                             'sequence': current_file.state()}, writers)
+
+        if state and limit:
+            # Files started after the last checkpoint are removed
+            index = current_file.index + 1
+            while os.path.exists(output_name(index)):
+                os.remove(output_name(index))
+                index += 1
+        elif checkpoint and not state:
+            save_checkpoint(reader_position(reader))
+
+        for (identifier, bad, route, data), position in records:
             record_count += 1
-            record_count_in_file += 1
             if record_count % 100 == 0:
                 print('{} records processed'.format(str(record_count)), end='\r')
 
-            # Check whether we need to start a new file
-            current_size += len(record.as_xml()) if xml else len(record.as_marc())
-            if (limit == 'size' and current_size >= max_size) \
-                    or (limit == 'number' and record_count_in_file > max_size):
-                if xml: current_file.write(CLOSE)
-                current_file.close()
-                print('{} records processed'.format(str(record_count)), end='\r')
-                print('\nFile {} done'.format(str(current_idx)))
-                current_size = len(record.as_xml()) if xml else len(record.as_marc())
-                record_count_in_file = 0
-                current_idx += 1
-                mid = FMT % current_idx if limit == 'size' else '.{}'.format(
-                    str(current_idx)) if limit == 'number' else ''
-                filename = os.path.join(output_path, root + mid + ext)
-                if xml:
-                    current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-                    current_file.write(OPEN)
-                else:
-                    current_file = open(filename, mode='wb')
-                    writer = MARCWriter(current_file)
-
-            record_to_write = '{}{}<metadata>{}\n</metadata>\n</record>'.format(OAI_RECORD, record.header(), record.as_xml(namespace=True)) if header \
-                else record.as_xml()
-
-            if record.is_bad():
-                if xml:
-                    files['errors'].file_object.write(record_to_write)
-                else: files['errors'].file_writer.write(record)
+            if bad:
+                files['errors'].file_object.write_bytes(data)
             else:
                 # Write record to main output file
-                if xml: current_file.write(record_to_write)
-                else: writer.write(record)
+                if current_file.write(data):
+                    print('{} records processed'.format(str(record_count)), end='\r')
+                    print('\nFile {} done'.format(str(current_file.index - 1)))
                 # If splitting by date, write record to appropriate output file
-                if date:
-                    fmt = '%Y%m%d' if tidy else '%d/%m/%Y'
-                    try:
-                        f = 'post' if (record.created != 'NEVER' and datetime.datetime.strptime(record.created, fmt) >= date) \
-                                      or (record.modified != 'NEVER' and datetime.datetime.strptime(record.modified,  fmt) >= date) else 'pre'
-                    except: print('\nError parsing date')
-                    else:
-                        if xml: files[f].file_object.write(record_to_write)
-                        else: files[f].file_writer.write(record)
-
-    # Write closing elements in files
-    if xml:
-        current_file.write(CLOSE)
-        for f in files:
-            if f != 'input' and files[f] and files[f].file_object:
-                files[f].file_object.write(CLOSE)
+                if route == 'error': print('\nError parsing date')
+                elif route: files[route].file_object.write_bytes(data)
+
+            if checkpoint and record_count % CHECKPOINT_INTERVAL == 0: save_checkpoint(position)
 
     print('{} records processed'.format(str(record_count)), end='\r')
+    if where: print('\n{} records did not match the filter expression'.format(str(reader.skipped)))
 
     # Close files
     for f in [ifile, current_file]:
-        f.close()
+        if f: f.close()
     for f in files:
         try: files[f].file_object.close()
         except: pass
+    if checkpoint: checkpoint.remove()
+
+    # Deletions are written, and the store updated, only once all other output is complete
+    if store:
+        print('\n{} records were unchanged'.format(str(store.unchanged)))
+        deleted = store.deleted()
+        filename = os.path.join(output_path, root + '_deleted' + ext)
+        writer = MARCXMLWriter(open_compressed(filename, mode='wb'), header=header, buffer_size=WRITE_BUFFER_SIZE) if xml \
+            else MARCWriter(open_compressed(filename, mode='wb'), buffer_size=WRITE_BUFFER_SIZE)
+        datestamp = datetime.date.today().isoformat()
+        for identifier in deleted: writer.write(DeletedRecord(identifier, datestamp))
+        writer.close()
+        store.commit()
+        store.close()
+        print('{} deleted records written to {}'.format(str(len(deleted)), filename))
 
     date_time_exit()
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main(sys.argv[1:])
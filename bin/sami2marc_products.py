@@ -6,7 +6,9 @@
 # ====================
 
 # Import required modules
+from contextlib import redirect_stdout
 from math import log10
+import multiprocessing
 from samiTools.marc_data import *
 import profile
 
@@ -34,11 +36,19 @@ ARGUMENTS = OrderedDict([
 
 OPTIONS = OrderedDict([
     ('--max_size', 'Split output by size or number of records'),
+    ('--jobs', 'Number of input files to convert at the same time'),
+    ('--where', 'Only convert records matching a filter expression'),
+    ('--keep-tags', 'Only keep fields with the listed tags'),
+    ('--drop-tags', 'Remove fields with the listed tags'),
+    ('--partition-by', 'Split output into files by the value of an expression'),
+    ('--compress', 'Compress output files with gz, bz2 or xz'),
+    ('--delta', 'Only write records which are new or changed since the last run'),
 ])
 
 FLAGS = OrderedDict([
     ('-x', 'Output files will be MARC XML rather than MARC 21 (.lex)'),
     ('--header', 'Include MetAg headers in MARC XML records'),
+    ('--subdirs', 'Place individual records in hashed subdirectories'),
     ('--help', 'Display help message and exit'),
 ])
 
@@ -52,8 +62,11 @@ def usage(extended=False):
     """Function to print information about the program"""
     print('\nCorrect syntax is:\n')
     print('sami2marc_authorities -i <ifile> -o <ofile>'
-          '\n\t\t\t[--max_size <number|size>]'
-          '\n\t\t\t[-x] [--header]')
+          '\n\t\t\t[--max_size <number|size>|--partition-by <expression>] [--jobs <number>]'
+          '\n\t\t\t[--where <expression>]'
+          '\n\t\t\t[--keep-tags <tags>] [--drop-tags <tags>]'
+          '\n\t\t\t[--compress <gz|bz2|xz>] [--delta <store>]'
+          '\n\t\t\t[-x] [--header] [--subdirs]')
     print('\nArguments:')
     for o in ARGUMENTS:
         print_opt(o, ARGUMENTS[o])
@@ -61,6 +74,8 @@ def usage(extended=False):
 
 Use quotation marks (") around arguments which contain spaces
 Input files should be SAMI Products files, in .xml, .prn or text format
+Input files with the further extension .gz, .bz2 or .xz (e.g. .prn.gz) will 
+be decompressed as they are read
 Output file should be either MARC exchange (.lex) or MARC XML (.xml).\
 
 """)
@@ -75,7 +90,9 @@ Output file should be either MARC exchange (.lex) or MARC XML (.xml).\
             
 If parameter --max_size is specified:
     max_size is EITHER the maximum number of records in an output file 
-    OR the (approx) maximum file size (in KB) if the number has the suffix 'K';
+    OR the maximum file size (in KB) if the number has the suffix 'K';
+    a file will only be larger than this if it contains a single record 
+    which is larger;
     Output will be written to a sequence of files with the same name as the 
     input file, but with a suffix indicating its order in the generated 
     output sequence
@@ -83,7 +100,67 @@ If parameter --max_size is specified:
     individual records) in which case the output files will be labelled with 
     the record identifier;
     Records with duplicate identifiers will be labelled with _DUPLICATE;
-    Records without identifiers will be labelled with _NO IDENTIFIER.
+    Records without identifiers will be labelled with _NO IDENTIFIER;
+    If --subdirs is also specified, the files will be placed in 
+    subdirectories (such as ab/cd/) named from a hash of their labels.
+
+If parameter --jobs is specified:
+    The specified number of input files will be converted at the same time, 
+    starting with the largest files;
+    A report for each file will be displayed once it has been converted.
+
+If parameter --where is specified:
+    Only records matching the expression will be converted; records are 
+    tested before they are parsed, so records which do not match cost 
+    little time;
+    The expression is one or more terms separated by &, all of which 
+    must match:
+        TAG         the record has a field with tag TAG, e.g. 596
+        FORM=VALUE  the FORM= line of a text record has the value VALUE; 
+                    alternative values may be separated by |
+    Any term may be negated by prefixing it with !;
+    --where may be given more than once, in which case all of the 
+    expressions must match;
+    e.g. --where "FORM=DOCREC|WORK & 596".
+
+If parameter --keep-tags or --drop-tags is specified:
+    With --keep-tags, only fields with the listed tags will be kept; 
+    with --drop-tags, fields with the listed tags will be removed; 
+    fields which are not wanted are skipped before they are parsed;
+    Tags are separated by commas, and X matches any character, 
+    e.g. --keep-tags 001,1XX,245,999;
+    Records from which the 001 is removed have no identifier.
+
+If parameter --partition-by is specified:
+    Records will be written to a separate output file for each value of 
+    the expression, named <input file>_<value>; records with no value 
+    will be written to <input file>_NO VALUE; if values differ only in 
+    case, _2, _3, etc. is added to the names of the later files;
+    The expression is NAME[$CODE][:year], where NAME is a tag, or FORM 
+    (for text files);
+    For a tag, the value of the first field with the tag is used, or the 
+    value of its first subfield CODE (by default, its first subfield);
+    With :year, only the first 4-digit year in the value is used;
+    e.g. --partition-by 999$m, or --partition-by FORM.
+    NOTE: --partition-by cannot be used with --max_size.
+
+If parameter --compress is specified:
+    Output files will be compressed with gzip (gz), bzip2 (bz2) or xz (xz), 
+    and given the further extension .gz, .bz2 or .xz;
+    Compression takes place in a background thread while records are 
+    converted.
+
+If parameter --delta is specified:
+    A hash of each record written is kept, by identifier, in the SQLite 
+    database <store>, which is created if it does not exist;
+    Only records which are new, or which have changed since the last run 
+    with the same store, will be written;
+    Records in the store which are no longer in any of the input files 
+    will be written to the file deleted.lex (or deleted.xml) in the output 
+    folder as deletions (with a deleted <header> if --header is specified, 
+    or otherwise with record status d);
+    The store is only updated once all files have been converted;
+    NOTE: --delta cannot be used with --where or --jobs.
 
 If parameter --header is specified:
     MARC XML records will be given a <header> to make them suitable for the 
@@ -94,6 +171,140 @@ If parameter --header is specified:
     exit_prompt()
 
 
+def is_input_file(file):
+    """Function to determine whether a file in the input folder should be converted"""
+    file = split_compression(file)[0]
+    root, ext = os.path.splitext(file)
+    return ext in ['.xml', '.prn'] or file.endswith(SAMI_SUFFICES) or any(f in root for f in PRIMO_FLAGS)
+
+
+def is_unchanged(store, record, data):
+    """Function to check whether the data for a record was written by the last run, as for --delta"""
+    if store is None: return False
+    identifier = record.identifier()
+    return identifier is not None and not store.changed(identifier, data)
+
+
+def convert_job(job):
+    """Function to convert a file within a worker process, capturing its report"""
+    report = io.StringIO()
+    with redirect_stdout(report):
+        record_count = convert_file(*job, progress=False)
+    return job[0], record_count, report.getvalue()
+
+
+def convert_file(file, input_path, output_path, settings, progress=True, store=None):
+    """Function to convert a single input file, returning the number of records converted
+
+    If store is given, records which are unchanged since the last run are not written"""
+    xml, header, split, subdirs = settings['xml'], settings['header'], settings['split'], settings['subdirs']
+    limit, max_size, where, partition = settings['limit'], settings['max_size'], settings['where'], settings['partition']
+    root, ext = os.path.splitext(split_compression(file)[0])
+    deleted = False
+    if any(f in root for f in PRIMO_FLAGS):
+        root = root + ext
+        ext = '.xml'
+
+    date_time('Processing file {} ...'.format(str(file)))
+    if '_dels' in root:
+        deleted = True
+        print('File contains deleted records')
+
+    # Open input file
+    ifile = open_compressed(os.path.join(input_path, file), mode='r', encoding='utf-8', errors='replace')
+    reader_type = 'prn' if ext == '.prn' else 'xml' if ext == '.xml' else 'txt'
+    ext = ('.xml' if xml else '.lex') + settings['compression']
+    reader = sami_factory(reader_type=reader_type, target=ifile, where=where, tags=settings['tags'])
+
+    # Special case if file is to be split into separate records
+    if split:
+        record_count = 0
+        # Files are created exclusively, so that files converted at the same time cannot overwrite each other
+        splitter = SplitWriter(output_path, ext, subdirs=subdirs)
+        writer = MARCXMLWriter(None, header=header, single=True, deleted=deleted)
+        for record in reader:
+            record_count += 1
+            if progress and record_count % 100 == 0:
+                print('{} records processed'.format(str(record_count)), end='\r')
+            data = writer.encode(writer.record_xml(record)) if xml else record.as_marc()
+            if is_unchanged(store, record, data): continue
+            splitter.write(record.identifier(), record_count, data)
+        splitter.close()
+        ifile.close()
+        print('{} records processed'.format(str(record_count)), end='\r')
+        if where: print('\n{} records did not match the filter expression'.format(str(reader.skipped)))
+        return record_count
+
+    # Special case if output is partitioned between files by the value of an expression
+    if partition:
+        record_count = 0
+        names = PartitionNames()
+
+        def open_partition(key, append):
+            filename = os.path.join(output_path, '{}_{}{}'.format(root, names.get(key), ext))
+            # Compressed XML files cannot be reopened within their collections, so records are added in a new compressed stream,
+            # and the collections are closed when the pool is closed
+            if xml and settings['compression']:
+                return MARCXMLWriter(open_compressed(filename, mode='ab' if append else 'wb'), header=header, deleted=deleted,
+                                     resume=append, buffer_size=WRITE_BUFFER_SIZE, open_ended=True)
+            if xml: return MARCXMLWriter(open_compressed(filename, mode='r+b' if append else 'wb'), header=header, deleted=deleted,
+                                         append=append, buffer_size=WRITE_BUFFER_SIZE)
+            return MARCWriter(open_compressed(filename, mode='ab' if append else 'wb'), buffer_size=WRITE_BUFFER_SIZE)
+
+        pool = WriterPool(open_partition, reopen=bool(xml and settings['compression']))
+        formatter = MARCXMLWriter(None, header=header, deleted=deleted)
+        for record in reader:
+            record_count += 1
+            if progress and record_count % 100 == 0:
+                print('{} records processed'.format(str(record_count)), end='\r')
+            data = formatter.encode(formatter.record_xml(record)) if xml else record.as_marc()
+            if is_unchanged(store, record, data): continue
+            pool.get(partition.value(record) or 'NO VALUE').write_bytes(data)
+        pool.close()
+        ifile.close()
+        print('{} records processed'.format(str(record_count)), end='\r')
+        if where: print('\n{} records did not match the filter expression'.format(str(reader.skipped)))
+        print('\nRecords written to {} files'.format(str(len(pool.keys))))
+        return record_count
+
+    # All other cases
+    FMT = None
+    record_count = 0
+
+    if limit == 'size':
+        FMT = ".%%0%dd" % (int(log10(os.path.getsize(os.path.join(input_path, file)) / max_size)) + 1)
+
+    def open_file(index):
+        mid = FMT % index if limit == 'size' else '.{}'.format(str(index)) if limit == 'number' else ''
+        filename = os.path.join(output_path, root + mid + ext)
+        if xml: return MARCXMLWriter(open_compressed(filename, mode='wb'), header=header, deleted=deleted, buffer_size=WRITE_BUFFER_SIZE)
+        return MARCWriter(open_compressed(filename, mode='wb'), buffer_size=WRITE_BUFFER_SIZE)
+
+    # Output is split into a new file before a file would exceed the maximum size or number of records
+    writer = SequenceWriter(open_file, max_size=max_size if limit == 'size' else None,
+                            max_records=max_size if limit == 'number' else None)
+    formatter = MARCXMLWriter(None, header=header, deleted=deleted)
+
+    for record in reader:
+        record_count += 1
+        if progress and record_count % 100 == 0:
+            print('{} records processed'.format(str(record_count)), end='\r')
+
+        # Serialize and encode the record once; the same bytes are measured and written
+        data = formatter.encode(formatter.record_xml(record)) if xml else record.as_marc()
+        if is_unchanged(store, record, data): continue
+        if writer.write(data):
+            print('{} records processed'.format(str(record_count)), end='\r')
+            print('\nFile {} done'.format(str(writer.index - 1)))
+
+    print('{} records processed'.format(str(record_count)), end='\r')
+    if where: print('\n{} records did not match the filter expression'.format(str(reader.skipped)))
+    # Close files
+    writer.close()
+    ifile.close()
+    return record_count
+
+
 # ====================
 #      Main code
 # ====================
@@ -103,11 +314,17 @@ def main(argv=None):
     if argv is None: name = str(sys.argv[1])
     if argv is None: name = str(sys.argv[1])
 
-    xml, split, header, deleted = False, False, False, False
+    xml, split, header, deleted, subdirs = False, False, False, False, False
     opts, args = None, None
     input_path, output_path = None, None
     limit = None
     max_size = 1024 * 1024 * 1024
+    jobs = 1
+    where = []
+    keep_tags, drop_tags, tags = [], [], None
+    partition = None
+    compression = ''
+    delta = None
 
     print('========================================')
     print('sami2marc_products')
@@ -118,7 +335,7 @@ to MARC 21 Bibliographic files in MARC exchange (.lex) or MARC XML format\
 """)
 
     try:
-        opts, args = getopt.getopt(argv, 'hi:o:m:x', ['input_path=', 'output_path=', 'max_size=', 'header', 'help'])
+        opts, args = getopt.getopt(argv, 'hi:o:m:x', ['input_path=', 'output_path=', 'max_size=', 'jobs=', 'where=', 'keep-tags=', 'drop-tags=', 'partition-by=', 'compress=', 'delta=', 'header', 'subdirs', 'help'])
     except getopt.GetoptError as err:
         exit_prompt('Error: {}'.format(err))
     if opts is None or not opts:
@@ -130,6 +347,8 @@ to MARC 21 Bibliographic files in MARC exchange (.lex) or MARC XML format\
             xml = True
         elif opt in ['-h', '--header']:
             header = True
+        elif opt == '--subdirs':
+            subdirs = True
         elif opt in ['-i', '--input_path']:
             input_path = arg
         elif opt in ['-o', '--output_path']:
@@ -145,6 +364,27 @@ to MARC 21 Bibliographic files in MARC exchange (.lex) or MARC XML format\
                                               'Please ensure that it is a positive integer, \n'
                                               'optionally followed by the suffix K.')
             if limit == 'size': max_size *= 1024
+        elif opt == '--where':
+            where.append(arg)
+        elif opt == '--partition-by':
+            try: partition = PartitionKey(arg, keys=SAMIReaderText.keys)
+            except FilterError as err: exit_prompt('Error: {}'.format(err))
+        elif opt == '--delta':
+            delta = arg
+        elif opt == '--compress':
+            compression = '.' + arg.lower().lstrip('.')
+            if compression not in COMPRESSION:
+                exit_prompt('Error: Compression could not be interpreted. \n'
+                            'Please use one of {}.'.format(', '.join(c.lstrip('.') for c in COMPRESSION)))
+        elif opt == '--keep-tags':
+            keep_tags.extend(arg.split(','))
+        elif opt == '--drop-tags':
+            drop_tags.extend(arg.split(','))
+        elif opt == '--jobs':
+            try: jobs = int(arg)
+            except: jobs = 0
+            if not jobs >= 1: exit_prompt('Number of jobs could not be interpreted. \n'
+                                          'Please ensure that it is a positive integer.')
         else:
             exit_prompt('Error: Option {} not recognised'.format(opt))
 
@@ -161,6 +401,20 @@ to MARC 21 Bibliographic files in MARC exchange (.lex) or MARC XML format\
     if header and not xml:
         exit_prompt('Error: Option --header cannot be used without -x')
 
+    if partition and limit:
+        exit_prompt('Error: Option --partition-by cannot be used with --max_size')
+
+    if where:
+        try: where = RecordFilter(' & '.join(where))
+        except FilterError as err: exit_prompt('Error: {}'.format(err))
+        # Only text files have values other than tags which can be tested
+        if not where.keys() <= set(SAMIReaderText.keys):
+            exit_prompt('Error: Filter expression cannot test {}'.format(', '.join(sorted(where.keys() - set(SAMIReaderText.keys)))))
+
+    if keep_tags or drop_tags:
+        try: tags = TagFilter(keep=keep_tags, drop=drop_tags)
+        except FilterError as err: exit_prompt('Error: Tags could not be interpreted: {}'.format(err.args[0]))
+
     # --------------------
     # Parameters seem OK => start program
     # --------------------
@@ -174,125 +428,77 @@ to MARC 21 Bibliographic files in MARC exchange (.lex) or MARC XML format\
         if max_size == 1:
             split = True
             print('Output file will be split into individual records')
+            if subdirs: print('Records will be placed in hashed subdirectories')
         else: print('Maximum file size : {} {}'.format(str(max_size), 'bytes' if limit == 'size' else 'records'))
     if header:
         print('MetAg headers will be used')
+    if subdirs and not split:
+        exit_prompt('Error: Option --subdirs can only be used with --max_size 1')
+    if jobs > 1:
+        print('{} files will be converted at the same time'.format(str(jobs)))
+    if where:
+        print('Only records matching the filter expression will be converted')
+    if tags:
+        print('Only fields with the selected tags will be converted')
+    if partition:
+        print('Output will be split into files by the value of the expression')
+    if compression:
+        print('Output files will be compressed ({})'.format(compression))
+    if delta and (where or jobs > 1):
+        exit_prompt('Error: Option --delta cannot be used with --where or --jobs')
+    if delta:
+        print('Only records which are new or changed will be written')
+
+    settings = {'xml': xml, 'header': header, 'split': split, 'limit': limit, 'max_size': max_size, 'subdirs': subdirs, 'where': where or None,
+                'tags': tags, 'partition': partition, 'compression': compression}
 
     # --------------------
     # Iterate through input files
     # --------------------
 
-    for file in os.listdir(input_path):
-        root, ext = os.path.splitext(file)
-        deleted = False
-        if ext in ['.xml', '.prn'] or file.endswith(SAMI_SUFFICES) or any(f in root for f in PRIMO_FLAGS):
-            if any(f in root for f in PRIMO_FLAGS):
-                root = root + ext
-                ext = '.xml'
-
-            date_time('Processing file {} ...'.format(str(file)))
-            if '_dels' in root:
-                deleted = True
-                print('File contains deleted records')
-
-            # Open input file
-            ifile = open(os.path.join(input_path, file), mode='r', encoding='utf-8', errors='replace')
-            reader_type = 'prn' if ext == '.prn' else 'xml' if ext == '.xml' else 'txt'
-            ext = '.xml' if xml else '.lex'
-            reader = sami_factory(reader_type=reader_type, target=ifile)
-
-            OPEN = OAI_HEADER if header else XML_HEADER
-            CLOSE = '\n</ListRecords>\n</OAI-PMH>' if header else '\n</marc:collection>'
-
-            # Special case if file is to be split into separate records
-            if split:
-                record_count = 0
-                for record in reader:
-                    record_count += 1
-                    if record_count % 100 == 0:
-                        print('{} records processed'.format(str(record_count)), end='\r')
-                    filename = os.path.join(output_path, (record.identifier() or '_NO IDENTIFIER {}'.format(str(record_count))) + ext)
-                    file_count = 0
-                    while os.path.isfile(filename):
-                        file_count += 1
-                        filename = os.path.join(output_path, (record.identifier() or '_NO IDENTIFIER {}'.format(str(record_count))) + '_DUPLICATE {}'.format(str(file_count)) + ext)
-                    if xml:
-                        current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-                        if header:
-                            current_file.write(METAG_HEADER + record.header(deleted=deleted))
-                            if not (deleted or record.deleted):
-                                current_file.write('<metadata>{}\n</metadata>\n'.format(record.as_xml(namespace=True)))
-                            current_file.write('</record>')
-                        else:
-                            current_file.write('{}{}\n</marc:collection>'.format(XML_HEADER, record.as_xml()))
-                    else:
-                        current_file = open(filename, mode='wb')
-                        writer = MARCWriter(current_file)
-                        writer.write(record)
-                    current_file.close()
-                ifile.close()
-                print('{} records processed'.format(str(record_count)), end='\r')
-                continue
-
-            # All other cases
-            FMT = None
-            record_count, record_count_in_file = 0, 0
-            current_idx, current_size = 0, 0
-
-            if limit == 'size':
-                FMT = ".%%0%dd" % (int(log10(os.path.getsize(os.path.join(input_path, file)) / max_size)) + 1)
-
-            mid = FMT % current_idx if limit == 'size' else '.{}'.format(str(current_idx)) if limit == 'number' else ''
-            filename = os.path.join(output_path, root + mid + ext)
-
-            if xml:
-                current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-                current_file.write(OPEN)
-            else:
-                current_file = open(filename, mode='wb')
-                writer = MARCWriter(current_file)
-
-            for record in reader:
-                record_count += 1
-                record_count_in_file += 1
-                if record_count % 100 == 0:
-                    print('{} records processed'.format(str(record_count)), end='\r')
-
-                # Check whether we need to start a new file
-                current_size += len(record.as_xml()) if xml else len(record.as_marc())
-                if (limit == 'size' and current_size >= max_size) \
-                        or (limit == 'number' and record_count_in_file > max_size):
-                    if xml: current_file.write(CLOSE)
-                    current_file.close()
-                    print('{} records processed'.format(str(record_count)), end='\r')
-                    print('\nFile {} done'.format(str(current_idx)))
-                    current_size = len(record.as_xml()) if xml else len(record.as_marc())
-                    record_count_in_file = 0
-                    current_idx += 1
-                    mid = FMT % current_idx if limit == 'size' else '.{}'.format(str(current_idx)) if limit == 'number' else ''
-                    filename = os.path.join(output_path, root + mid + ext)
-                    if xml:
-                        current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-                        current_file.write(OPEN)
-                    else:
-                        current_file = open(filename, mode='wb')
-                        writer = MARCWriter(current_file)
-
-                record_to_write = '{}{}{}</record>'.format(OAI_RECORD, record.header(deleted=deleted),
-                                                           '<metadata>{}\n</metadata>\n'.format(record.as_xml(namespace=True)) if not (deleted or record.deleted) else '') if header \
-                    else record.as_xml()
-
-                if xml: current_file.write(record_to_write)
-                else: writer.write(record)
-
-            if xml: current_file.write(CLOSE)
-            print('{} records processed'.format(str(record_count)), end='\r')
-            # Close files
-            for f in [ifile, current_file]:
-                f.close()
+    files = [file for file in os.listdir(input_path) if is_input_file(file)]
+
+    if jobs > 1:
+        # Convert the largest files first, so that the last file to finish is a small one
+        files.sort(key=lambda file: os.path.getsize(os.path.join(input_path, file)), reverse=True)
+        print('\n\nConverting {} files using {} processes ...'.format(str(len(files)), str(jobs)))
+        total = 0
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for file, record_count, report in pool.imap_unordered(convert_job, [(file, input_path, output_path, settings) for file in files]):
+                total += record_count
+                print(report, end='')
+                print('\n{} records in file {}'.format(str(record_count), file))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        print('\n\n{} records processed in {} files'.format(str(total), str(len(files))))
+    else:
+        store = None
+        if delta:
+            try: store = RecordStore(delta)
+            except sqlite3.Error as err: exit_prompt('Error: The store {} could not be opened: {}'.format(delta, err))
+        for file in files:
+            convert_file(file, input_path, output_path, settings, store=store)
+
+        # Deletions are written, and the store updated, only once all files have been converted
+        if store:
+            print('\n\n{} records were unchanged'.format(str(store.unchanged)))
+            deleted = store.deleted()
+            filename = os.path.join(output_path, 'deleted' + ('.xml' if xml else '.lex') + compression)
+            writer = MARCXMLWriter(open_compressed(filename, mode='wb'), header=header, buffer_size=WRITE_BUFFER_SIZE) if xml \
+                else MARCWriter(open_compressed(filename, mode='wb'), buffer_size=WRITE_BUFFER_SIZE)
+            datestamp = datetime.date.today().isoformat()
+            for identifier in deleted: writer.write(DeletedRecord(identifier, datestamp))
+            writer.close()
+            store.commit()
+            store.close()
+            print('{} deleted records written to {}'.format(str(len(deleted)), filename))
 
     date_time_exit()
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main(sys.argv[1:])
 
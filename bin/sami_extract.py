@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# ====================
+#       Set-up
+# ====================
+
+# Import required modules
+from samiTools.marc_data import *
+
+# Set locale to assist with sorting
+locale.setlocale(locale.LC_ALL, '')
+
+# Set threshold for garbage collection (helps prevent the program run out of memory)
+gc.set_threshold(400, 5, 5)
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#   Global variables
+# ====================
+
+
+ARGUMENTS = OrderedDict([
+    ('-i', 'path to Input file'),
+    ('-o', 'path to Output file'),
+])
+
+OPTIONS = OrderedDict([
+    ('--ids', 'path to a file listing the identifiers of the records to extract'),
+    ('--type', 'Type of the input file: authorities, txt, prn, xml or marc'),
+])
+
+FLAGS = OrderedDict([
+    ('--rebuild', 'Build the index again even if it is up to date'),
+    ('--help', 'Display help message and exit'),
+])
+
+# Reader type of an input file, by its extension; files with other extensions are SAMI text files
+READER_TYPES = {
+    '.txt': 'authorities',
+    '.prn': 'prn',
+    '.xml': 'xml',
+    '.lex': 'marc',
+    '.mrc': 'marc',
+}
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def usage(extended=False):
+    """Function to print information about the program"""
+    print('\nCorrect syntax is:\n')
+    print('sami_extract -i <ifile> [-o <ofile> --ids <file>]'
+          '\n\t\t\t[--type <authorities|txt|prn|xml|marc>] [--rebuild]')
+    print('\nArguments:')
+    for o in ARGUMENTS:
+        print_opt(o, ARGUMENTS[o])
+    print("""\
+
+Use quotation marks (") around arguments which contain spaces
+Input file should be a SAMI file (authorities, text, .prn or XML),
+or a MARC exchange file (.lex); it cannot be compressed
+Output file should be either MARC exchange (.lex) or MARC XML (.xml).\
+
+""")
+    print('Options:')
+    for o in OPTIONS:
+        print_opt(o, OPTIONS[o])
+    print('\nFlags:')
+    for o in FLAGS:
+        print_opt(o, FLAGS[o])
+    if extended:
+        print("""\
+
+The index of the input file is saved alongside it in <ifile>.idx,
+and is built if it does not exist or if the input file has changed
+since it was built; records can then be extracted without reading
+the whole of the input file.
+
+If parameter --ids is specified:
+    The records with the identifiers listed in the file (one to a line)
+    will be written to the output file, in the order in which they are
+    listed; if more than one record has the same identifier, only the
+    first is written;
+    Identifiers are the SAMI identifiers (e.g. XX246721) of authority
+    records, and the 001 of other records.
+    If --ids is not specified, the index is built and no records are
+    extracted.
+
+If parameter --type is specified:
+    The input file is read as the specified type; otherwise the type is
+    chosen from the file extension: .txt for authorities, .prn, .xml,
+    .lex for marc, and text for any other extension.\
+    """)
+    exit_prompt()
+
+
+# ====================
+#      Main code
+# ====================
+
+
+def main(argv=None):
+    if argv is None: name = str(sys.argv[1])
+
+    opts, args = None, None
+    input_file, output_file, ids_file = None, None, None
+    reader_type = None
+    rebuild = False
+
+    print('========================================')
+    print('sami_extract')
+    print('========================================')
+    print("""\
+This program indexes a SAMI or MARC file by record identifier,
+and extracts the records with listed identifiers\
+""")
+
+    try: opts, args = getopt.getopt(argv, 'hi:o:', ['ifile=', 'ofile=', 'ids=', 'type=', 'rebuild', 'help'])
+    except getopt.GetoptError as err:
+        exit_prompt('Error: {}'.format(err))
+    if opts is None or not opts:
+        usage()
+    for opt, arg in opts:
+        if opt in ['-h', '--help']:
+            usage(extended=True)
+        elif opt == '--rebuild':
+            rebuild = True
+        elif opt in ['-i', '--ifile']:
+            input_file = arg
+        elif opt in ['-o', '--ofile']:
+            output_file = FilePath(arg, 'output')
+        elif opt == '--ids':
+            ids_file = arg
+        elif opt == '--type':
+            reader_type = arg.lower()
+            if reader_type not in READER_TYPES.values() and reader_type != 'txt':
+                exit_prompt('Error: Type {} is not supported'.format(arg))
+        else:
+            exit_prompt('Error: Option {} not recognised'.format(opt))
+
+    if not input_file:
+        exit_prompt('Error: No path to input file has been specified')
+    if not os.path.isfile(input_file):
+        exit_prompt('Error: The specified input file cannot be found')
+    if split_compression(input_file)[1]:
+        exit_prompt('Error: Compressed files cannot be indexed')
+    if ids_file and not os.path.isfile(ids_file):
+        exit_prompt('Error: The specified file of identifiers cannot be found')
+    if ids_file and not output_file:
+        exit_prompt('Error: No path to output file has been specified')
+    if output_file and not ids_file:
+        exit_prompt('Error: Option -o cannot be used without --ids')
+    if not reader_type: reader_type = READER_TYPES.get(os.path.splitext(input_file)[1].lower(), 'txt')
+
+    # --------------------
+    # Parameters seem OK => start program
+    # --------------------
+
+    # Display confirmation information about the transformation
+
+    print('Input file: {}'.format(input_file))
+    print('Input file type: {}'.format(reader_type))
+    if output_file:
+        print('Output file: {}'.format(output_file.path))
+
+    index = RecordIndex(input_file, reader_type)
+    try:
+        if rebuild: raise IndexFileError(index.index_path)
+        record_count = index.load()
+        date_time('Index {} is up to date'.format(index.index_path))
+    except IndexFileError:
+        date_time('Building index {} ...'.format(index.index_path))
+        record_count = index.build()
+    print('{} records indexed'.format(str(record_count)))
+
+    if ids_file:
+        date_time('Extracting records ...')
+        with open(ids_file, mode='r', encoding='utf-8', errors='replace') as file:
+            identifiers = [line.strip() for line in file if line.strip()]
+        ofile = open_compressed(output_file.path, mode='wb')
+        writer = MARCXMLWriter(ofile, buffer_size=WRITE_BUFFER_SIZE) if output_file.ext == '.xml' \
+            else MARCWriter(ofile, buffer_size=WRITE_BUFFER_SIZE)
+        found = 0
+        for identifier in identifiers:
+            record = index.get(identifier)
+            if record is None:
+                print('No record with identifier {}'.format(identifier))
+                continue
+            writer.write(record)
+            found += 1
+        writer.close()
+        index.close()
+        print('{} of {} records written to {}'.format(str(found), str(len(identifiers)), output_file.path))
+
+    date_time_exit()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,10 +2,13 @@ C:/python34/python setup.py install
 C:/python34/python setup.py py2exe
 mv dist/sami2marc_products.exe sami2marc_products.exe
 mv dist/sami2marc_authorities.exe sami2marc_authorities.exe
+mv dist/sami_extract.exe sami_extract.exe
 cp sami2marc_products.exe ../sami2marc_products.exe
 cp sami2marc_authorities.exe ../sami2marc_authorities.exe
+cp sami_extract.exe ../sami_extract.exe
 rmdir dist
 rm bin/__pycache__/sami2marc_products.cpython-34.pyc
 rm bin/__pycache__/sami2marc_authorities.cpython-34.pyc
+rm bin/__pycache__/sami_extract.cpython-34.pyc
 rmdir bin/__pycache__
 rm -rf build
\ No newline at end of file
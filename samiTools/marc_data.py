@@ -20,6 +20,18 @@ LEADER_LENGTH, DIRECTORY_ENTRY_LENGTH = 24, 12
 SUBFIELD_INDICATOR, END_OF_FIELD, END_OF_RECORD = chr(0x1F), chr(0x1E), chr(0x1D)
 ALEPH_CONTROL_FIELDS = ['DB ', 'SYS', 'LDR']
 
+READ_BLOCK_SIZE = 8 * 1024 * 1024
+# Number of bytes of encoded records collected by a writer before they are written to its file
+WRITE_BUFFER_SIZE = 256 * 1024
+# Maximum number of output files kept open at a time when output is partitioned
+WRITER_POOL_SIZE = 64
+# Number of records held in memory before their files are created when output is split into individual records
+SPLIT_BATCH_SIZE = 1000
+LONE_CR = re.compile(br'\r(?!\n)')
+# Extension of the sidecar file in which RecordIndex saves the index of a file
+INDEX_EXTENSION = '.idx'
+INDEX_VERSION = 'samiTools index 1'
+
 SUBS = OrderedDict([
     ('c', re.compile(r'<copyNumber>(.*?)</copyNumber>')),
     ('i', re.compile(r'<itemID>(.*?)</itemID>')),
@@ -33,6 +45,12 @@ SUBS = OrderedDict([
     ('z', re.compile(r'<category2>(.*?)</category2>')),
 ])
 
+# Field line in an authority record: '  TAG:   |content'
+AUTHORITY_FIELD = re.compile(r' +(\S{3}): +(\|.*)')
+
+# Subfield codes of the elements of <item> in .prn exports
+ITEM_ELEMENTS = dict((SUBS[s].pattern[1:SUBS[s].pattern.index('>')], s) for s in SUBS if SUBS[s])
+
 
 XML_HEADER = '<?xml version="1.0" encoding="UTF-8" ?>' \
              '\n<marc:collection xmlns:marc="http://www.loc.gov/MARC21/slim" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' \
@@ -61,6 +79,18 @@ OAI_RECORD = '\n<record ' \
              'xmlns:bl="http://www.bl.uk/schemas/digitalobject/entities#" ' \
              'xmlns:blit="http://bl.uk/namespaces/blit">'
 
+XML_CLOSE = '\n</marc:collection>'
+
+OAI_CLOSE = '\n</ListRecords>\n</OAI-PMH>'
+
+# Templates for the elements of MARC XML records
+XML_RECORD = '\n\t<marc:record>'
+XML_RECORD_NS = '\n\t<marc:record xsi:schemaLocation="http://www.loc.gov/MARC21/slim http://www.loc.gov/standards/marcxml/schema/MARC21slim.xsd">'
+XML_LEADER = '\n\t\t<marc:leader>{}</marc:leader>'
+XML_CONTROLFIELD = '\t\t<marc:controlfield tag="{}">{}</marc:controlfield>'
+XML_DATAFIELD = '\t\t<marc:datafield tag="{}" ind1="{}" ind2="{}">'
+XML_SUBFIELD = '\n\t\t\t<marc:subfield code="{}">{}</marc:subfield>'
+
 
 # ====================
 #     Exceptions
@@ -95,27 +125,189 @@ class RecordWritingError(Exception):
     def __str__(self): return 'Error writing record'
 
 
+class HeaderError(Exception):
+    def __str__(self): return 'Record header does not have 9 columns separated by double tabs: {!r}'.format(self.args[0])
+
+
+class FilterError(Exception):
+    def __str__(self): return 'Filter expression could not be interpreted: {!r}'.format(self.args[0])
+
+
+class IndexFileError(Exception):
+    def __str__(self): return 'Index file {!r} does not exist or is out of date'.format(self.args[0])
+
+
 # ====================
 #       Classes
 # ====================
 
 
-def sami_factory(reader_type, target, tidy=False):
+def sami_factory(reader_type, target, tidy=False, where=None, tags=None):
     """Returns the correct SAMIReader object depending on the reader_type"""
-    if reader_type == 'authorities': return SAMIReaderAuthorities(target, tidy)
-    if reader_type == 'prn': return SAMIReaderPRN(target, tidy)
-    if reader_type == 'xml': return SAMIReaderXML(target, tidy)
-    if reader_type == 'txt': return SAMIReaderText(target, tidy)
-    raise Exception('The reader_type {} is not supported.'.format(reader_type))
+    if reader_type == 'authorities': reader = SAMIReaderAuthorities(target, tidy)
+    elif reader_type == 'prn': reader = SAMIReaderPRN(target, tidy)
+    elif reader_type == 'xml': reader = SAMIReaderXML(target, tidy)
+    elif reader_type == 'txt': reader = SAMIReaderText(target, tidy)
+    else: raise Exception('The reader_type {} is not supported.'.format(reader_type))
+    reader.where, reader.tags = where, tags
+    return reader
+
+
+class RecordFilter(object):
+    """Filter selecting records by testing their raw text, so that records which do not match are never parsed
+
+    An expression is one or more terms separated by '&', all of which must match:
+        TAG         the record has a field with tag TAG (such as 596)
+        KEY=VALUE   the value named KEY (FORM, or a column of the authorities header) is VALUE;
+                    alternative values may be separated by '|'
+    Any term may be negated by prefixing it with '!'"""
+
+    def __init__(self, expression):
+        self.terms = []
+        for term in expression.split('&'):
+            term = term.strip()
+            negate = term.startswith('!')
+            if negate: term = term[1:].strip()
+            key, sep, values = term.partition('=')
+            key = key.strip()
+            if sep and re.match(r'^[A-Za-z_]+$', key):
+                self.terms.append((negate, key.lower(), frozenset(v.strip() for v in values.split('|'))))
+            elif not sep and re.match(r'^[0-9A-Za-z]{3}$', key):
+                self.terms.append((negate, key, None))
+            else: raise FilterError(expression)
+
+    def keys(self):
+        """Returns the set of names of the values tested by the filter"""
+        return {key for negate, key, values in self.terms if values is not None}
+
+    def matches(self, data, reader):
+        """Checks whether the raw text of a record, read by reader, matches the filter"""
+        for negate, key, values in self.terms:
+            if values is None: found = reader.has_tag(data, key)
+            else: found = reader.value(data, key) in values
+            if found == negate: return False
+        return True
+
+
+class TagFilter(object):
+    """Filter selecting the fields of records by their tags, so that fields which are not wanted are never parsed
+
+    keep and drop are lists of tags, in which X matches any character (as in 1XX);
+    a tag is accepted if it matches a tag in keep (if given) and does not match any tag in drop"""
+
+    def __init__(self, keep=None, drop=None):
+        self.keep = self.compile(keep) if keep else None
+        self.drop = self.compile(drop) if drop else None
+        self._accepted = {}
+
+    @staticmethod
+    def compile(tags):
+        """Function to convert a list of tags into a regular expression"""
+        patterns = []
+        for tag in tags:
+            tag = tag.strip()
+            if len(tag) != 3: raise FilterError(tag)
+            patterns.append(''.join('.' if c in 'Xx' else re.escape(c) for c in tag))
+        return re.compile(r'(?:{})\Z'.format('|'.join(patterns)))
+
+    def accepts(self, tag):
+        """Checks whether fields with the given tag should be kept"""
+        try: return self._accepted[tag]
+        except KeyError: pass
+        accepted = (self.keep is None or self.keep.match(tag) is not None) and (self.drop is None or self.drop.match(tag) is None)
+        self._accepted[tag] = accepted
+        return accepted
+
+
+class PartitionKey(object):
+    """Key by which records are partitioned between output files
+
+    An expression is NAME[$CODE][:year], where NAME is either a tag (such as 999), or one of keys, the names of the values
+    which can be read from a record (FORM, or a column of the authorities header); names of values take precedence over tags.
+    For a tag, the value is that of the first field with the tag, or of its first subfield CODE (by default, its first subfield).
+    With :year, only the first 4-digit year in the value is used"""
+
+    def __init__(self, expression, keys=()):
+        match = re.match(r'^\s*([0-9A-Za-z_]+)(?:\$(.))?(:year)?\s*$', expression)
+        if not match: raise FilterError(expression)
+        name, self.code, self.year = match.group(1), match.group(2), bool(match.group(3))
+        # Tags are 3 characters of digits or capital letters; any other name must be that of a value
+        if name.lower() in keys: self.tag, self.key = None, name.lower()
+        elif re.match(r'^[0-9A-Z]{3}$', name): self.tag, self.key = name, None
+        else: raise FilterError(expression)
+
+    def value(self, record):
+        """Returns the value of the key for a SAMIRecord, in a form which may be used in a file name, or None"""
+        value = None
+        if self.key: value = record.value(self.key)
+        else:
+            for field in record.record.get_fields(self.tag):
+                if field.is_control_field(): value = field.data
+                elif self.code: value = field[self.code]
+                else: value = next((v for c, v in field), None)
+                break
+        if value and self.year:
+            match = re.search(r'(?<![0-9])[0-9]{4}', value)
+            value = match.group() if match else None
+        if value: value = re.sub(r'[^\w.-]+', '_', value.strip()).strip('_')
+        return value or None
+
+
+class PartitionNames(object):
+    """Class to map the values by which records are partitioned to the names used for their files
+
+    Names differ from each other and from the reserved names (such as errors) other than in case, so that values
+    never share a file, even on file systems which ignore case; if the name of a value is taken, _2, _3, etc. is added"""
+
+    def __init__(self, reserved=()):
+        self.names = {}
+        self.taken = {name.lower() for name in reserved}
+
+    def get(self, value):
+        """Function to return the name for a value"""
+        try: return self.names[value]
+        except KeyError: pass
+        name, n = value, 1
+        while name.lower() in self.taken:
+            n += 1
+            name = '{}_{}'.format(value, n)
+        self.taken.add(name.lower())
+        self.names[value] = name
+        return name
 
 
 class SAMIReader(object):
 
+    # Pattern locating candidate record boundaries within a block of raw input;
+    # every line for which new_record() is True must contain a match
+    boundary = None
+
+    # Pattern (formatted with a tag) locating a field in the raw text of a record
+    tag_pattern = r'\btag="{}"'
+
+    # Names of the values which can be read from the raw text of a record by value()
+    keys = ()
+
     def __init__(self, target, tidy=False):
+        self.file_handle = None
+        # A path is opened here; compressed files are decompressed as they are read
+        if isinstance(target, str): target = open_compressed(target, mode='r', encoding='utf-8', errors='replace')
         if hasattr(target, 'read') and callable(target.read):
             self.file_handle = target
         self.deleted = '_dels' in str(target)
         self.tidy = tidy
+        self.encoding = getattr(target, 'encoding', None) or 'utf-8'
+        self.errors = getattr(target, 'errors', None) or 'replace'
+        # Byte offsets at which the last record found by chunks() started and ended
+        self.record_start, self.offset = 0, 0
+        # If set, iteration (and selected_chunks()) stops at the first record which starts at or after this byte offset
+        self.end = None
+        self.where, self.tags = None, None
+        self.skipped = 0
+        self._chunks = None
+        self._tag_patterns = {}
+        # Records ending at or before this byte offset are not returned, as they were read before a conversion was resumed
+        self._resume_offset = 0
 
     def __iter__(self):
         return self
@@ -126,35 +318,184 @@ class SAMIReader(object):
             self.file_handle = None
 
     def __next__(self):
-        chunk = ''
-        line = self.file_handle.readline()
-        if not line: raise StopIteration
-        while chunk == '' and line and (self.new_record(line) or self.while_chunk(line)):
-            line = self.file_handle.readline()
-            if not line: break
-        while line and not self.new_record(line):
-            chunk += line
-            line = self.file_handle.readline()
-            if not line: break
-        if not chunk: raise StopIteration
-        return self.record(data=chunk, tidy=self.tidy)
+        if self._chunks is None: self._chunks = self.selected_chunks()
+        return self.record(data=next(self._chunks), tidy=self.tidy)
+
+    def selected_chunks(self):
+        """Generator yielding the text of each record in the input which matches self.where (if set)
+
+        The number of records which do not match is kept in self.skipped"""
+        for data in self.chunks():
+            if self.end is not None and self.record_start >= self.end: return
+            if self.offset <= self._resume_offset: continue
+            if self.where is None or self.where.matches(data, self): yield data
+            else: self.skipped += 1
+
+    def seek(self, offset, end=None):
+        """Function to continue reading the input from byte offset, where a record returned by an earlier reader ended
+        or where a record in a RecordIndex starts; if end is given, iterating over the reader (or selected_chunks())
+        stops at the first record starting at or after end, while chunks() still reads to the end of the input
+
+        Input which cannot be repositioned (such as a compressed file) is read up to offset and discarded"""
+        stream = self._binary_stream()
+        seekable = getattr(stream, 'seekable', None)
+        if seekable and seekable(): stream.seek(offset)
+        else:
+            remaining = offset
+            while remaining > 0:
+                block = stream.read(min(remaining, READ_BLOCK_SIZE))
+                if not block: break
+                remaining -= len(block)
+        self.offset = self._resume_offset = offset
+        self.end = end
+
+    def read_record(self, offset, length):
+        """Function to return the record whose raw text is the length bytes at byte offset, as saved by RecordIndex"""
+        stream = self._binary_stream()
+        stream.seek(offset)
+        self.offset = offset
+        for data in self.chunks(io.BytesIO(stream.read(length))):
+            return self.record(data=data, tidy=self.tidy)
+        return None
+
+    def identifier(self, data):
+        """Returns the identifier of a record from its raw text, as used by RecordIndex"""
+        return self.record(data=data, tidy=self.tidy).identifier()
+
+    def has_tag(self, data, tag):
+        """Checks whether the raw text of a record contains a field with the given tag"""
+        pattern = self._tag_patterns.get(tag)
+        if pattern is None:
+            pattern = self._tag_patterns[tag] = re.compile(self.tag_pattern.format(re.escape(tag)), re.M)
+        return pattern.search(data) is not None
+
+    def value(self, data, key):
+        """Returns the value named key from the raw text of a record, or None if it cannot be read"""
+        return None
+
+    def chunks(self, stream=None):
+        """Generator yielding the text of each record in the input, without parsing it.
+
+        The input is read in large binary blocks; record boundaries are located with one search
+        per candidate line rather than by testing every line, and each record is decoded as a single slice.
+        After each record is yielded, self.record_start and self.offset hold the byte offsets at which it started and ended.
+        If stream is given, records are read from it rather than from the input file."""
+        if stream is None: stream = self._binary_stream()
+        buffer = bytearray()
+        base, scanned, translated = self.offset, 0, 0
+        while True:
+            block = stream.read(READ_BLOCK_SIZE)
+            buffer += block
+            # Universal newlines: translate lone carriage returns to line feeds (this preserves byte offsets)
+            limit = len(buffer) - 1 if block else len(buffer)
+            if buffer.find(b'\r', translated, limit) != -1:
+                for m in LONE_CR.finditer(buffer, translated):
+                    if m.start() >= limit: break
+                    buffer[m.start()] = 0x0A
+            translated = max(limit, 0)
+            # Only complete lines are searched for boundaries
+            end = buffer.rfind(b'\n') + 1
+            if block and end == 0: continue
+            start = pos = 0
+            if self.boundary:
+                for m in self.boundary.finditer(buffer, scanned, end):
+                    if m.start() < pos: continue
+                    line_start = buffer.rfind(b'\n', 0, m.start()) + 1
+                    line_end = buffer.find(b'\n', m.start(), end) + 1
+                    if self.is_boundary(buffer[line_start:line_end]):
+                        chunk = self._chunk(buffer, base, start, line_start)
+                        if chunk: yield chunk
+                        start = line_end
+                    pos = line_end
+            if not block:
+                stop = len(buffer)
+                if end < stop and self.new_record(self._decode(buffer[end:])): stop = end
+                chunk = self._chunk(buffer, base, start, stop)
+                if chunk: yield chunk
+                self.offset = base + len(buffer)
+                return
+            del buffer[:start]
+            base += start
+            scanned, translated = end - start, translated - start
+
+    def is_boundary(self, raw):
+        """Checks a candidate line (in raw bytes) found by the boundary pattern"""
+        return self.new_record(self._decode(raw))
+
+    def _binary_stream(self):
+        if self.file_handle is None: return io.BytesIO()
+        if hasattr(self.file_handle, 'buffer'): return self.file_handle.buffer
+        if isinstance(self.file_handle, io.TextIOBase): return _EncodedStream(self.file_handle, self.encoding, self.errors)
+        return self.file_handle
+
+    def _decode(self, raw):
+        text = raw.decode(self.encoding, self.errors)
+        if '\r' in text: text = text.replace('\r\n', '\n')
+        return text
+
+    def _chunk(self, buffer, base, start, stop):
+        if start >= stop: return None
+        text = self._decode(buffer[start:stop])
+        self.record_start, self.offset = base + start, base + stop
+        # Skip lines at the start of a record which do not form part of it
+        i = 0
+        while i < len(text):
+            j = text.find('\n', i) + 1 or len(text)
+            if not self.while_chunk(text[i:j]): break
+            i = j
+        if i: text = text[i:]
+        return text or None
 
     def while_chunk(self, line):
         if 'xmlns:xsi' in line: return True
         return False
 
     def record(self, data, tidy):
-        return SAMIRecord(data=data, tidy=tidy)
+        return SAMIRecord(data=data, tidy=tidy, tags=self.tags)
 
     def new_record(self, line):
         return False
 
 
+class _PrefixedStream(object):
+    """Binary stream returning data which has already been read from another stream, followed by the rest of it"""
+
+    def __init__(self, prefix, stream):
+        self.prefix, self.stream = prefix, stream
+
+    def read(self, size=-1):
+        if not self.prefix: return self.stream.read(size)
+        data, self.prefix = self.prefix, b''
+        return data
+
+
+class _EncodedStream(object):
+    """Binary view of a text stream which has no underlying buffer"""
+
+    def __init__(self, file_handle, encoding, errors):
+        self.file_handle, self.encoding, self.errors = file_handle, encoding, errors
+
+    def read(self, size=-1):
+        return self.file_handle.read(size).encode(self.encoding, self.errors)
+
+
 class SAMIReaderAuthorities(SAMIReader):
 
+    boundary = re.compile(br'^(?:\.end|[\t\x0b\x0c\r\x1c-\x1f \x80-\xff]*\n)', re.M)
+    tag_pattern = r'^ {{1,3}}{}: +\|'
+    # Columns of the record header, without padding; dates are as in the input (d/m/yyyy, e.g. 9/11/2016)
+    keys = ('id', 'fmt', 'level', 'created', 'created_by', 'modified', 'modified_by', 'cataloged', 'source')
+
     def __init__(self, target, tidy=False):
         super().__init__(target, tidy)
 
+    def value(self, data, key):
+        try: return SAMIRecordAuthorities.split_header(data.split('\n', 1)[0])[self.keys.index(key)].strip()
+        except (HeaderError, ValueError): return None
+
+    def identifier(self, data):
+        return clean_text(self.value(data, 'id'))
+
     def while_chunk(self, line):
         if 'xmlns:xsi' in line: return True
         if line.strip() == '': return True
@@ -162,7 +503,11 @@ class SAMIReaderAuthorities(SAMIReader):
         return False
 
     def record(self, data, tidy):
-        return SAMIRecordAuthorities(data=data, tidy=tidy)
+        return SAMIRecordAuthorities(data=data, tidy=tidy, tags=self.tags)
+
+    def is_boundary(self, raw):
+        if raw.startswith(b'.end') or not raw.strip(): return True
+        return super().is_boundary(raw)
 
     def new_record(self, line):
         if line.startswith('.end') or line.strip() == '': return True
@@ -171,11 +516,23 @@ class SAMIReaderAuthorities(SAMIReader):
 
 class SAMIReaderText(SAMIReader):
 
+    boundary = re.compile(br'\*\*\* DOCUMENT BOUNDARY \*\*\*')
+    tag_pattern = r'^\.{}\.'
+    keys = ('form',)
+
     def __init__(self, target, tidy=False):
         super().__init__(target, tidy)
 
+    def value(self, data, key):
+        match = re.search(r'FORM=(.*)', data) if key == 'form' else None
+        if match: return match.group(1).strip()
+        return None
+
     def record(self, data, tidy):
-        return SAMIRecordText(data=data, tidy=tidy)
+        return SAMIRecordText(data=data, tidy=tidy, tags=self.tags)
+
+    def is_boundary(self, raw):
+        return True
 
     def new_record(self, line):
         if '*** DOCUMENT BOUNDARY ***' in line: return True
@@ -184,11 +541,13 @@ class SAMIReaderText(SAMIReader):
 
 class SAMIReaderPRN(SAMIReader):
 
+    boundary = re.compile(br'<(?:\?xml version|title>|/?report>|dateFormat>|catalog>|dateCreated>[0-9]{4}-[0-9]{2}-[0-9]{2}T)')
+
     def __init__(self, target, tidy=False):
         super().__init__(target, tidy)
 
     def record(self, data, tidy):
-        return SAMIRecordPRN(data=data, tidy=tidy)
+        return SAMIRecordPRN(data=data, tidy=tidy, tags=self.tags)
 
     def new_record(self, line):
         if any(s in line for s in ['<?xml version', '<title>', '<report>', '</report>', '<dateFormat>', '<catalog>']): return True
@@ -198,11 +557,95 @@ class SAMIReaderPRN(SAMIReader):
 
 class SAMIReaderXML(SAMIReader):
 
+    boundary = re.compile(br'<record xmlns="http://www\.loc\.gov/mods/v3">|<record xmlns:rdf=|<\?xml version|</?OAI-PMH|</?ListRecords>')
+    boundary_deleted = re.compile(boundary.pattern + br'|<record>|xmlns="http://www\.openarchives\.org/OAI/2\.0/"'
+                                                     br'|xsi:schemaLocation="http://www\.openarchives\.org/OAI/2\.0/'
+                                                     br'|http://www\.openarchives\.org/OAI/2\.0/OAI- PMH\.xsd"')
+
     def __init__(self, target, tidy=False):
         super().__init__(target, tidy)
+        if self.deleted: self.boundary = self.boundary_deleted
+        # Text and fields of the last record found by chunks(), so that it need not be parsed again
+        self._parsed = None
 
     def record(self, data, tidy):
-        return SAMIRecordXML(data=data, tidy=tidy)
+        if self._parsed and self._parsed[0] is data:
+            return SAMIRecordXML(data=data, tidy=tidy, fields=self._parsed[1], tags=self.tags)
+        return SAMIRecordXML(data=data, tidy=tidy, tags=self.tags)
+
+    def chunks(self, stream=None):
+        """Generator yielding the text of each record in the input, found by parsing the input with expat.
+
+        A record is an OAI-PMH <record>, or a MARC XML record (with or without the marc: prefix) which is not within one,
+        wherever the lines of the file are broken. Only the text of the current record is held in memory.
+        If reading starts after the beginning of the input (see seek()), the records are parsed within a root element
+        supplied here, and reading stops at the end of the element which contained them.
+        If the input is not well-formed UTF-8 XML, it is read from the end of the last complete record
+        by searching for boundary lines, as for other SAMI files."""
+        if stream is None: stream = self._binary_stream()
+        if codecs.lookup(self.encoding).name != 'utf-8':
+            yield from super().chunks(stream)
+            return
+        root = b'<records>' if self.offset > 0 else b''
+        # The buffer holds the input from byte offset base onwards; the parser counts bytes from origin
+        buffer, base, origin = bytearray(), self.offset, self.offset - len(root)
+        open_records, spans = [], []
+        parser = expat.ParserCreate()
+        # Entities which are not defined (such as HTML entities) are passed through rather than being errors
+        parser.UseForeignDTD(True)
+        # The fields of each record are read in the same pass
+        fields = MARCXMLParser(self.tags)
+        fields.parser, fields.raw, fields.shift = parser, buffer, base - origin
+
+        def start_element(name, attrs):
+            if name != 'record' and not name.endswith(':record'):
+                if open_records: fields.start_element(name, attrs)
+                return
+            start = origin + parser.CurrentByteIndex
+            if not open_records:
+                fields.controlfields, fields.datafields = [], []
+                tag_end = buffer.find(b'>', start - base)
+                # Empty <record/> elements are skipped
+                if buffer[tag_end - 1:tag_end] == b'/': start = None
+            open_records.append(start)
+
+        def end_element(name):
+            if name != 'record' and not name.endswith(':record'):
+                if open_records: fields.end_element(name)
+                return
+            start = open_records.pop()
+            if open_records or start is None: return
+            end = origin + parser.CurrentByteIndex
+            spans.append((start, base + buffer.find(b'>', end - base) + 1, (fields.controlfields, fields.datafields)))
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        if root: parser.Parse(root, False)
+
+        while True:
+            block = stream.read(READ_BLOCK_SIZE)
+            buffer += block
+            error = None
+            try: parser.Parse(bytes(block), not block)
+            except expat.ExpatError as e: error = e
+            for start, end, parsed in spans:
+                text = self._decode(buffer[start - base:end - base])
+                self.record_start, self.offset, self._parsed = start, end, (text, parsed)
+                yield text
+            self._parsed = None
+            if spans:
+                del buffer[:spans[-1][1] - base]
+                base = spans[-1][1]
+                fields.shift = base - origin
+                spans = []
+            if error:
+                if root and not open_records: return
+                self.offset = base
+                # The rest of the line on which the last complete record ended (such as its line break) is not a record
+                for chunk in super().chunks(_PrefixedStream(bytes(buffer), stream)):
+                    if chunk.strip(): yield chunk
+                return
+            if not block: return
 
     def new_record(self, line):
         if any(s in line for s in ['<record xmlns="http://www.loc.gov/mods/v3">', '<record xmlns:rdf=', '<?xml version',
@@ -215,13 +658,22 @@ class SAMIReaderXML(SAMIReader):
 
 class SAMIRecord(object):
 
-    def __init__(self, data, tidy=False):
+    def __init__(self, data, tidy=False, tags=None):
         self.record = MARCRecord()
         self.data = data
         self.deleted = '<header status="deleted">' in data
         self.tidy = tidy
+        self.tags = tags
         self.error = False
 
+    def accepts(self, tag):
+        """Checks whether fields with the given tag should be added to the record"""
+        return self.tags is None or self.tags.accepts(tag)
+
+    def value(self, key):
+        """Returns a value named as for RecordFilter, or None"""
+        return None
+
     def as_marc(self):
         return self.record.as_marc()
 
@@ -257,40 +709,43 @@ class SAMIRecord(object):
 
 class SAMIRecordAuthorities(SAMIRecord):
 
-    def __init__(self, data, tidy=False):
-        super().__init__(data, tidy)
+    def __init__(self, data, tidy=False, tags=None):
+        super().__init__(data, tidy, tags)
 
-        self.data = re.sub(r'\n[ ]{4,}', ' ', self.data)
-        self.sid, self.fmt, self.level, self.created, self.created_by, self.modified, self.modified_by, self.cataloged, self.source = data.split('\n', 1)[0].rstrip('\t').split('\t\t')
+        lines = self.data.split('\n')
+        try: header = self.split_header(lines[0])
+        except HeaderError as e:
+            # The record is treated as bad, keeping those columns of the header which could be read
+            print(str(e))
+            self.error = True
+            header = (lines[0].split('\t\t') + [''] * 9)[:9]
+        self.sid, self.fmt, self.level, self.created, self.created_by, self.modified, self.modified_by, self.cataloged, self.source = header
 
         if self.tidy:
             if self.created != 'NEVER':
-                try: self.created = datetime.datetime.strftime(datetime.datetime.strptime(self.created, '%d/%m/%Y'), '%Y%m%d')
-                except:
+                try: self.created = parse_date(self.created)[0]
+                except ValueError:
                     print('Error parsing created date')
                     self.error = True
             if self.modified != 'NEVER':
-                try: self.modified = datetime.datetime.strftime(datetime.datetime.strptime(self.modified, '%d/%m/%Y'), '%Y%m%d')
-                except:
+                try: self.modified = parse_date(self.modified)[0]
+                except ValueError:
                     print('Error parsing modified date')
                     self.error = True
 
-        self.record.add_ordered_field(Field(tag='901', indicators=[' ', ' '], subfields=['a', 'id: ' + self.sid]))
-        self.record.add_ordered_field(Field(tag='902', indicators=[' ', ' '], subfields=['a', 'fmt: ' + self.fmt]))
-        self.record.add_ordered_field(Field(tag='903', indicators=[' ', ' '], subfields=['a', 'level: ' + self.level]))
+        header_fields = [('901', ['a', 'id: ' + self.sid]), ('902', ['a', 'fmt: ' + self.fmt]), ('903', ['a', 'level: ' + self.level])]
         if self.tidy:
-            self.record.add_ordered_field(Field(tag='904', indicators=[' ', ' '], subfields=['a', 'created: ' + self.created, 'b', 'created_by: ' + self.created_by]))
-            self.record.add_ordered_field(Field(tag='906', indicators=[' ', ' '], subfields=['a', 'modified: ' + self.modified, 'b', 'modified_by: ' + self.modified_by]))
+            header_fields.extend([('904', ['a', 'created: ' + self.created, 'b', 'created_by: ' + self.created_by]),
+                                  ('906', ['a', 'modified: ' + self.modified, 'b', 'modified_by: ' + self.modified_by])])
         else:
-            self.record.add_ordered_field(Field(tag='904', indicators=[' ', ' '], subfields=['a', 'created: ' + self.created]))
-            self.record.add_ordered_field(Field(tag='905', indicators=[' ', ' '], subfields=['a', 'created_by: ' + self.created_by]))
-            self.record.add_ordered_field(Field(tag='906', indicators=[' ', ' '], subfields=['a', 'modified: ' + self.modified]))
-            self.record.add_ordered_field(Field(tag='907', indicators=[' ', ' '], subfields=['a', 'modified_by: ' + self.modified_by]))
-        self.record.add_ordered_field(Field(tag='908', indicators=[' ', ' '], subfields=['a', 'cataloged: ' + self.cataloged]))
-        self.record.add_ordered_field(Field(tag='909', indicators=[' ', ' '], subfields=['a', 'source: ' + self.source]))
-
-        for field in re.findall(r'(?<=[^\n])[ ]+([^\s]{3}):[ ]+(\|.*?)(?=[$|\n])', self.data):
-            tag, content = field[0], field[1]
+            header_fields.extend([('904', ['a', 'created: ' + self.created]), ('905', ['a', 'created_by: ' + self.created_by]),
+                                  ('906', ['a', 'modified: ' + self.modified]), ('907', ['a', 'modified_by: ' + self.modified_by])])
+        header_fields.extend([('908', ['a', 'cataloged: ' + self.cataloged]), ('909', ['a', 'source: ' + self.source])])
+        for tag, subfields in header_fields:
+            if self.accepts(tag): self.record.add_ordered_field(Field(tag=tag, indicators=[' ', ' '], subfields=subfields))
+
+        for tag, content in self.tokenize(lines[1:]):
+            if not self.accepts(tag): continue
             try: test = int(tag)
             except: test = None
             if tag == '000' or (test and test < 10) or tag in ALEPH_CONTROL_FIELDS:
@@ -304,7 +759,7 @@ class SAMIRecordAuthorities(SAMIRecord):
                 f = Field(tag=tag, indicators=[' ', ' '], subfields=subfields)
             self.record.add_ordered_field(f)
 
-        if self.tidy:
+        if self.tidy and self.accepts('001'):
             if '001' not in self.record:
                 if self.sid != '':
                     self.record.add_ordered_field(Field(tag='001', data=self.sid.strip()))
@@ -312,57 +767,200 @@ class SAMIRecordAuthorities(SAMIRecord):
                     print('Failed to add 001')
                     self.error = True
 
+    @staticmethod
+    def split_header(line):
+        """Function to split the header line of a record into its 9 columns, raising HeaderError if it cannot be split"""
+        columns = line.split('\t\t')
+        # The header ends with a separator, which leaves an empty final column
+        if len(columns) == 10 and not columns[9].strip('\t'): columns.pop()
+        elif len(columns) == 9: columns[8] = columns[8].rstrip('\t')
+        if len(columns) != 9: raise HeaderError(line)
+        return columns
+
+    def value(self, key):
+        # Values are without padding, as read by SAMIReaderAuthorities
+        if key not in SAMIReaderAuthorities.keys: return None
+        return getattr(self, 'sid' if key == 'id' else key).strip()
+
+    @staticmethod
+    def tokenize(lines):
+        """Function to read the fields from the lines of a record in a single pass
+
+        Returns a list of tuples (tag, content) for lines of the form '  TAG:   |content';
+        lines indented by four or more spaces continue the field before, and are joined to it with a single space"""
+        fields, content = [], None
+        for line in lines:
+            if line.startswith('    '):
+                if content is not None: content.append(line.lstrip(' '))
+                continue
+            match = AUTHORITY_FIELD.match(line)
+            content = None
+            if match:
+                content = [match.group(2)]
+                fields.append((match.group(1), content))
+        return [(tag, ' '.join(content)) for tag, content in fields]
 
-class SAMIRecordPRN(SAMIRecord):
 
-    def __init__(self, data, tidy=False):
-        super().__init__(data, tidy)
+class SAMIRecordPRN(SAMIRecord):
 
-        for field in re.findall(r'<marcEntry tag="(.*?)" label="(.*?)" ind="(.*?)">(.*?)</marcEntry>', self.data):
-            tag, label, ind1, ind2, content = field[0], field[1], field[2][0], field[2][1], field[3]
-            try: test = int(tag)
-            except: test = None
-            if tag == '000' or (test and test < 10) or tag in ALEPH_CONTROL_FIELDS:
-                try: f = Field(tag=tag, data=content.split('|a', 1)[1].strip())
-                except: f = Field(tag=tag, data=content.strip())
-            else:
-                subfields = []
-                for s in content.split('|')[1:]:
-                    try: subfields.extend([s[0], s[1:]])
-                    except: pass
-                f = Field(tag=tag, indicators=[ind1, ind2], subfields=subfields)
-            self.record.add_ordered_field(f)
-        self.data = ''.join(line for line in self.data.split('\n'))
-        for call in re.findall(r'<call>(.*?)</call>', self.data):
+    def __init__(self, data, tidy=False, tags=None):
+        super().__init__(data, tidy, tags)
+
+        # Holdings are only read if their 999 fields are wanted
+        holdings = self.accepts('999')
+        try: entries, holdings = PRNParser(holdings).parse(self.data)
+        except expat.ExpatError:
+            # Records which are not well-formed XML are read with regular expressions
+            entries, holdings = self.parse_regex(holdings)
+        for tag, ind, content in entries:
+            if self.accepts(tag): self.add_entry(tag, ind, content)
+        for call_number, library, item in holdings:
+            self.add_holding(call_number, library, item)
+        self.data = self.data.replace('\n', '')
+
+    def parse_regex(self, holdings=True):
+        """Function to find the MARC entries and holdings of the record using regular expressions
+
+        Returns the same lists as PRNParser.parse()"""
+        entries = [(tag, ind, content) for tag, label, ind, content in
+                   re.findall(r'<marcEntry tag="(.*?)" label="(.*?)" ind="(.*?)">(.*?)</marcEntry>', self.data)]
+        if not holdings: return entries, []
+        holdings = []
+        for call in re.findall(r'<call>(.*?)</call>', self.data.replace('\n', '')):
             try: call_number = re.search(r'<callNumber>(.*?)</callNumber>', call).group(1)
             except: call_number = '[NO CALL NUMBER]'
             try: library = re.search(r'<library>(.*?)</library>', call).group(1)
             except: library = None
             for item in re.findall(r'<item>(.*?)</item>', call):
-                subfields = ['a', call_number, 'w', 'ALPHANUM']
-                for s in SUBS:
-                    if s == 'm':
-                        if library:
-                            subfields.extend(['m', library])
-                        subfields.extend(['r', 'Y', 's', 'Y'])
-                    else:
-                        try: subfields.extend([s, re.search(SUBS[s], item).group(1).strip()])
-                        except:
-                            if s == 'u':
-                                try: subfields.extend([s, re.search(SUBS['d'], item).group(1).strip()])
-                                except: pass
-                            else: pass
-                f = Field(tag='999', indicators=[' ', ' '], subfields=subfields)
-                self.record.add_ordered_field(f)
+                values = {}
+                for s in ITEM_ELEMENTS.values():
+                    match = SUBS[s].search(item)
+                    if match: values[s] = match.group(1)
+                holdings.append((call_number, library, values))
+        return entries, holdings
+
+    def add_entry(self, tag, ind, content):
+        """Function to add a field to the record from the tag, indicators and content of a <marcEntry>"""
+        ind1, ind2 = ind[0], ind[1]
+        try: test = int(tag)
+        except: test = None
+        if tag == '000' or (test and test < 10) or tag in ALEPH_CONTROL_FIELDS:
+            try: f = Field(tag=tag, data=content.split('|a', 1)[1].strip())
+            except: f = Field(tag=tag, data=content.strip())
+        else:
+            subfields = []
+            for s in content.split('|')[1:]:
+                try: subfields.extend([s[0], s[1:]])
+                except: pass
+            f = Field(tag=tag, indicators=[ind1, ind2], subfields=subfields)
+        self.record.add_ordered_field(f)
+
+    def add_holding(self, call_number, library, item):
+        """Function to add a 999 field to the record for an <item>, given the values of its elements by subfield code"""
+        subfields = ['a', call_number, 'w', 'ALPHANUM']
+        for s in SUBS:
+            if s == 'm':
+                if library:
+                    subfields.extend(['m', library])
+                subfields.extend(['r', 'Y', 's', 'Y'])
+            elif s in item: subfields.extend([s, item[s].strip()])
+            elif s == 'u' and 'd' in item: subfields.extend([s, item['d'].strip()])
+        f = Field(tag='999', indicators=[' ', ' '], subfields=subfields)
+        self.record.add_ordered_field(f)
+
+
+class PRNParser(object):
+    """Class to read the MARC entries and holdings of a <catalog> from a .prn export in a single pass using expat
+
+    Text is kept as it appears in the export, without expanding entities, as when using regular expressions;
+    if holdings is False, <call> elements are skipped"""
+
+    def __init__(self, holdings=True):
+        self.read_holdings = holdings
+        self.entries, self.holdings = [], []
+        self.entry, self.call, self.items, self.item = None, None, None, None
+        # Element whose text is being read, the dictionary and key in which it will be stored, and its text
+        self.element, self.target, self.text = None, None, None
+
+    def parse(self, data):
+        """Function to parse the contents of a <catalog>, returning lists of its entries and holdings
+
+        Entries are tuples (tag, ind, content); holdings are tuples (call_number, library, item),
+        where item is a dictionary of the values of the elements of the <item> by subfield code"""
+        data = data.strip()
+        if data.startswith('<catalog>'): data = data[len('<catalog>'):]
+        if data.endswith('</catalog>'): data = data[:-len('</catalog>')]
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.DefaultHandler = self.default
+        parser.Parse('<catalog>{}</catalog>'.format(data), True)
+        return self.entries, self.holdings
+
+    def read_text(self, element, target, key):
+        self.element, self.target, self.text = element, (target, key), []
+
+    def start_element(self, name, attrs):
+        if self.element: return
+        if name == 'marcEntry' and all(a in attrs for a in ('tag', 'label', 'ind')):
+            self.entry = {'tag': attrs['tag'], 'ind': attrs['ind']}
+            self.read_text(name, self.entry, 'content')
+        elif name == 'call' and self.read_holdings:
+            self.call, self.items = {}, []
+        elif self.call is None: return
+        elif name == 'item':
+            self.item = {}
+        # The first <callNumber> and <library> anywhere within the <call> are used
+        elif name in ('callNumber', 'library') and name not in self.call:
+            self.read_text(name, self.call, name)
+        elif self.item is not None and name in ITEM_ELEMENTS and ITEM_ELEMENTS[name] not in self.item:
+            self.read_text(name, self.item, ITEM_ELEMENTS[name])
+
+    def end_element(self, name):
+        if self.element == name:
+            target, key = self.target
+            target[key] = ''.join(self.text)
+            self.element, self.target, self.text = None, None, None
+            if name != 'marcEntry': return
+            # Entries are only recognised within a single line
+            if '\n' not in self.entry['content']:
+                self.entries.append((self.entry['tag'], self.entry['ind'], self.entry['content']))
+            self.entry = None
+        elif name == 'item' and self.call is not None:
+            self.items.append(dict((s, v.replace('\n', '')) for s, v in self.item.items()))
+            self.item = None
+        elif name == 'call' and self.call is not None:
+            call_number = self.call.get('callNumber', '[NO CALL NUMBER]').replace('\n', '')
+            library = self.call['library'].replace('\n', '') if 'library' in self.call else None
+            self.holdings.extend((call_number, library, item) for item in self.items)
+            self.call, self.items = None, None
+
+    def default(self, data):
+        if self.text is not None: self.text.append(data)
 
 
 class SAMIRecordXML(SAMIRecord):
 
-    def __init__(self, data, tidy=False):
-        super().__init__(data, tidy)
-
+    def __init__(self, data, tidy=False, fields=None, tags=None):
+        super().__init__(data, tidy, tags)
+
+        # The fields may already have been read by SAMIReaderXML, as lists of control fields and data fields
+        try: controlfields, datafields = fields or MARCXMLParser(tags).parse(self.data)
+        except expat.ExpatError:
+            # Records which are not well-formed XML are read with regular expressions
+            self.parse_regex()
+            return
+        for tag, data in controlfields:
+            self.record.add_ordered_field(Field(tag=tag, data=data))
+        for tag, ind1, ind2, subfields in datafields:
+            self.record.add_ordered_field(Field(tag=tag, indicators=[ind1, ind2], subfields=subfields))
+        self.data = self.data.replace('\n', '')
+
+    def parse_regex(self):
+        """Function to add the fields of the record using regular expressions"""
         for field in re.findall(r'<(?:marc:)?controlfield tag="(.*?)">(.*?)</(?:marc:)?controlfield>', self.data, re.M):
             tag, data = field[0], field[1]
+            if not self.accepts(tag): continue
             subfields = []
             for s in re.findall(r'<(?:marc:)?subfield code="(.)">(.*?)</(?:marc:)?subfield>', data):
                 try: subfields.extend([s[0], s[1]])
@@ -373,6 +971,7 @@ class SAMIRecordXML(SAMIRecord):
         for field in re.findall(r'<(?:marc:)?datafield tag="(.*?)" ind1="(.?)" ind2="(.?)">(.*?)</(?:marc:)?datafield>', self.data,
                                 re.M):
             tag, ind1, ind2, data = field[0], field[1], field[2], field[3]
+            if not self.accepts(tag): continue
             if ind1 == '': ind1 = ' '
             if ind2 == '': ind2 = ' '
             subfields = []
@@ -383,20 +982,82 @@ class SAMIRecordXML(SAMIRecord):
             self.record.add_ordered_field(f)
 
 
+class MARCXMLParser(object):
+    """Class to read the fields of a MARC XML record in a single pass using expat
+
+    Text is taken from the record as it appears there, without expanding entities, as when using regular expressions;
+    if tags is given, only fields with tags accepted by the TagFilter are read"""
+
+    def __init__(self, tags=None):
+        self.tags = tags
+        self.controlfields, self.datafields = [], []
+        # Parser and raw input, and the offset of the parser's byte index from the start of the raw input
+        self.parser, self.raw, self.shift = None, None, 0
+        # Field and subfield being read, and the parser's byte index at which the text of the current element starts
+        # (which stays valid when the start of the raw input is discarded)
+        self.field, self.code, self.start = None, None, None
+
+    def parse(self, data):
+        """Function to parse a record, returning lists of its control fields and data fields
+
+        Control fields are tuples (tag, data); data fields are tuples (tag, ind1, ind2, subfields)"""
+        self.raw = '<chunk>{}</chunk>'.format(data).encode('utf-8')
+        self.parser = expat.ParserCreate()
+        self.parser.UseForeignDTD(True)
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.Parse(self.raw, True)
+        return self.controlfields, self.datafields
+
+    def text(self):
+        """Function to return the text from the start of the current element to the current position"""
+        text = self.raw[self.start - self.shift:self.parser.CurrentByteIndex - self.shift].decode('utf-8')
+        if '\r' in text: text = text.replace('\r\n', '\n')
+        return text.replace('\n', '')
+
+    def start_element(self, name, attrs):
+        if name.startswith('marc:'): name = name[len('marc:'):]
+        if name in ('controlfield', 'datafield') and self.tags is not None and not self.tags.accepts(attrs.get('tag', '')):
+            return
+        if name == 'controlfield' and 'tag' in attrs:
+            self.field = (attrs['tag'],)
+        elif name == 'datafield' and 'tag' in attrs:
+            self.field = (attrs['tag'], attrs.get('ind1', '')[:1] or ' ', attrs.get('ind2', '')[:1] or ' ', [])
+            return
+        elif name == 'subfield' and self.field and len(self.field) == 4 and len(attrs.get('code', '')) == 1:
+            self.code = attrs['code']
+        else: return
+        self.start = self.raw.find(b'>', self.parser.CurrentByteIndex - self.shift) + 1 + self.shift
+
+    def end_element(self, name):
+        if name.startswith('marc:'): name = name[len('marc:'):]
+        if name == 'controlfield' and self.field and len(self.field) == 1:
+            self.controlfields.append((self.field[0], self.text()))
+            self.field = None
+        elif name == 'subfield' and self.code:
+            self.field[3].extend([self.code, self.text()])
+            self.code = None
+        elif name == 'datafield' and self.field and len(self.field) == 4:
+            self.datafields.append(self.field)
+            self.field = None
+
+
 class SAMIRecordText(SAMIRecord):
 
-    def __init__(self, data, tidy=False):
-        super().__init__(data, tidy)
+    def __init__(self, data, tidy=False, tags=None):
+        super().__init__(data, tidy, tags)
 
         for line in self.data.split('\n'):
             if line:
                 if '*** DOCUMENT BOUNDARY ***' in line:
                     continue
                 elif 'FORM=' in line:
+                    if not self.accepts('FMT'): continue
                     f = Field(tag='FMT', indicators=[' ', ' '], subfields=['a', line.split('=', 1)[1].strip()])
                     self.record.add_ordered_field(f)
                 else:
                     tag = line[1:4]
+                    if not self.accepts(tag): continue
                     try:
                         test = int(tag)
                     except:
@@ -415,128 +1076,658 @@ class SAMIRecordText(SAMIRecord):
                         f = Field(tag=tag, indicators=[ind1, ind2], subfields=subfields)
                     self.record.add_ordered_field(f)
 
+    def value(self, key):
+        if key != 'form': return None
+        match = re.search(r'FORM=(.*)', self.data)
+        if match: return match.group(1).strip()
+        return None
+
+
+class DeletedRecord(SAMIRecord):
+    """Record standing for a record which has been deleted, of which only the identifier is known
+
+    As MARC, the record has the status d (deleted) and an 001; as MARC XML with a header, it is a deleted OAI-PMH record"""
+
+    def __init__(self, identifier, datestamp):
+        super().__init__(data='<datestamp>{}</datestamp>'.format(datestamp))
+        self.deleted = True
+        self.record.leader = self.record.leader[:5] + 'd' + self.record.leader[6:]
+        self.record.add_field(Field(tag='001', data=html.unescape(identifier)))
+
+
 class MARCReader(object):
 
     def __init__(self, marc_target):
+        self.file_handle, self.buffer, self._mmap = None, None, None
+        # A path is opened here; compressed files are decompressed as they are read
+        if isinstance(marc_target, str): marc_target = open_compressed(marc_target, mode='rb')
         if hasattr(marc_target, 'read') and callable(marc_target.read):
             self.file_handle = marc_target
+            # Files which can be memory-mapped are read without copying records;
+            # their fields are only decoded when first used
+            try:
+                self._mmap = mmap.mmap(marc_target.fileno(), 0, access=mmap.ACCESS_READ)
+                self.buffer = memoryview(self._mmap)
+                self.pos = marc_target.tell()
+            except (AttributeError, OSError, ValueError):
+                self._mmap, self.buffer = None, None
+        # Byte offsets at which the last record started and ended, and at which reading stops (if set)
+        try: self.offset = self.file_handle.tell()
+        except (AttributeError, OSError, ValueError): self.offset = 0
+        self.record_start, self.end = self.offset, None
 
     def __iter__(self):
         return self
 
     def close(self):
+        if self.buffer is not None:
+            self.buffer.release()
+            # The mapping stays open while records read from it are still in use
+            try: self._mmap.close()
+            except BufferError: pass
+            self._mmap, self.buffer = None, None
         if self.file_handle:
             self.file_handle.close()
             self.file_handle = None
 
     def __next__(self):
+        if self.end is not None and self.offset >= self.end: raise StopIteration
+        if self.buffer is not None: return self._next_mapped()
         first5 = self.file_handle.read(5)
         if not first5: raise StopIteration
         if len(first5) < 5: raise RecordLengthError
-        return MARCRecord(first5 + self.file_handle.read(int(first5) - 5))
+        data = first5 + self.file_handle.read(int(first5) - 5)
+        self.record_start, self.offset = self.offset, self.offset + len(data)
+        return MARCRecord(data)
+
+    def _next_mapped(self):
+        first5 = self.buffer[self.pos:self.pos + 5]
+        if len(first5) == 0: raise StopIteration
+        if len(first5) < 5: raise RecordLengthError
+        length = int(first5.tobytes())
+        end = self.pos + length if length >= 5 else len(self.buffer)
+        data = self.buffer[self.pos:end]
+        self.record_start, self.pos = self.pos, end
+        self.offset = end
+        return MARCRecord(data)
+
+    def seek(self, offset, end=None):
+        """Function to continue reading the input from byte offset, where a record in a RecordIndex starts;
+        if end is given, reading stops at the first record starting at or after end"""
+        if self.buffer is not None: self.pos = offset
+        elif self.file_handle.seekable(): self.file_handle.seek(offset)
+        else:
+            remaining = offset
+            while remaining > 0:
+                block = self.file_handle.read(min(remaining, READ_BLOCK_SIZE))
+                if not block: break
+                remaining -= len(block)
+        self.offset, self.end = offset, end
+
+    def read_record(self, offset, length):
+        """Function to return the record which is the length bytes at byte offset, as saved by RecordIndex"""
+        if self.buffer is not None: return MARCRecord(self.buffer[offset:offset + length])
+        self.file_handle.seek(offset)
+        return MARCRecord(self.file_handle.read(length))
+
+    def identifier(self, record):
+        """Returns the identifier (001) of a record, as used by RecordIndex"""
+        field = record['001']
+        return field.data if field is not None else None
+
+
+class BatchWriter(object):
+    """Class to write encoded records to a binary file handle in batches
+
+    Records are collected in a bytearray until buffer_size bytes are held, then written with a single call to write().
+    If buffer_size is 0, each record is written as soon as it is received.
+    Records which are still held are written by flush() and close(); flush() also flushes the file handle,
+    which for a compressed file waits until the data has been compressed"""
+
+    def __init__(self, file_handle, buffer_size=0):
+        self.file_handle, self.buffer_size = file_handle, buffer_size
+        self.buffer = bytearray()
+
+    def write_bytes(self, data):
+        """Function to write a record already encoded as bytes"""
+        if not self.buffer_size:
+            self.file_handle.write(data)
+            return
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size: self._write_buffer()
+
+    def _write_buffer(self):
+        self.file_handle.write(self.buffer)
+        del self.buffer[:]
+
+    def flush(self):
+        """Function to write any records held in the buffer to the file"""
+        if self.buffer: self._write_buffer()
+        self.file_handle.flush()
+
+    def close(self):
+        self.flush()
+        self.file_handle.close()
+        self.file_handle = None
 
 
-class MARCWriter(object):
-    def __init__(self, file_handle):
-        self.file_handle = file_handle
+class MARCWriter(BatchWriter):
+    """Class to write records as MARC 21 to a binary file handle, in batches of buffer_size bytes"""
 
     def write(self, record):
         if not isinstance(record, MARCRecord) and not isinstance(record, SAMIRecord):
             raise RecordWritingError
-        self.file_handle.write(record.as_marc())
+        self.write_bytes(record.as_marc())
+
+    def envelope(self):
+        """Function to return the bytes written before and after the records in a file"""
+        return b'', b''
+
+
+class MARCXMLWriter(BatchWriter):
+    """Class to write records as MARC XML to a binary file handle, in batches of buffer_size bytes
+
+    Records are written within a MARC XML collection, or within an OAI-PMH envelope if header is True.
+    If single is True, each record is written as a complete document, as for files containing a single record.
+    If append is True, file_handle is a file (opened with mode 'r+b') which was completed by another writer,
+    and records are added to the end of its collection.
+    If resume is True, file_handle is positioned at the end of a file which another writer had started but not completed,
+    and records are added to it.
+    If open_ended is True, close() does not write the end of the envelope, so that more records can be added to the file
+    by a writer opened with resume (as for a compressed file, which cannot be reopened within its envelope);
+    the envelope is ended by complete().
+    Deleted records are written without their <metadata>, unless deleted_metadata is True.
+    XML is encoded by encode(), with line endings as written by a file opened in text mode.
+    If file_handle is None the writer may only be used to format records with record_xml()"""
+
+    def __init__(self, file_handle, header=False, single=False, deleted=False, append=False, resume=False, buffer_size=0,
+                 deleted_metadata=False, open_ended=False):
+        BatchWriter.__init__(self, file_handle, buffer_size=buffer_size)
+        self.header, self.single, self.deleted, self.deleted_metadata = header, single, deleted, deleted_metadata
+        self.open_ended = open_ended
+        if file_handle is not None and not single:
+            if append: self._reopen()
+            elif not resume: self.file_handle.write(self.encode(OAI_HEADER if header else XML_HEADER))
+
+    def encode(self, xml):
+        """Function to encode MARC XML as bytes to be written to a file"""
+        if os.linesep != '\n': xml = xml.replace('\n', os.linesep)
+        return xml.encode('utf-8', errors='replace')
+
+    def _reopen(self):
+        """Function to remove the end of the envelope from a completed file, so that more records can be written to it"""
+        close = self.encode(OAI_CLOSE if self.header else XML_CLOSE)
+        end = self.file_handle.seek(0, io.SEEK_END) - len(close)
+        if end < 0: raise RecordWritingError
+        self.file_handle.seek(end)
+        if self.file_handle.read() != close: raise RecordWritingError
+        self.file_handle.seek(end)
+        self.file_handle.truncate()
+
+    def record_xml(self, record):
+        """Function to return the MARC XML for a record, within its envelope"""
+        if not isinstance(record, MARCRecord) and not isinstance(record, SAMIRecord):
+            raise RecordWritingError
+        if not self.header:
+            if self.single: return ''.join((XML_HEADER, record.as_xml(), XML_CLOSE))
+            return record.as_xml()
+        deleted = (self.deleted or record.deleted) and not self.deleted_metadata
+        return ''.join((METAG_HEADER if self.single else OAI_RECORD, record.header(deleted=self.deleted),
+                        '' if deleted else '<metadata>{}\n</metadata>\n'.format(record.as_xml(namespace=True)), '</record>'))
+
+    def write(self, record):
+        self.write_xml(self.record_xml(record))
+
+    def write_xml(self, xml):
+        """Function to write MARC XML already returned by record_xml()"""
+        self.write_bytes(self.encode(xml))
+
+    def envelope(self):
+        """Function to return the bytes written before and after the records in a file"""
+        if self.single: return b'', b''
+        return self.encode(OAI_HEADER if self.header else XML_HEADER), self.encode(OAI_CLOSE if self.header else XML_CLOSE)
 
     def close(self):
-        self.file_handle.close()
-        self.file_handle = None
+        if not self.single and not self.open_ended:
+            self.write_bytes(self.encode(OAI_CLOSE if self.header else XML_CLOSE))
+        BatchWriter.close(self)
+
+    def complete(self):
+        """Function to write the end of the envelope and close the file, even if the writer is open_ended"""
+        self.open_ended = False
+        self.close()
+
+
+class WriterPool(object):
+    """Class to write to many output files while keeping at most size of them open at a time
+
+    Writers are created by the function opener(key, append), where append is True if a writer for key
+    has been opened (and closed) before, so that the file should be added to rather than replaced.
+    When another writer must be opened, the writer which was least recently used is closed.
+    If reopen is True, the writers are open_ended MARCXMLWriters, whose files are completed only when the pool is closed;
+    the file of a writer which has already been closed is then reopened by the opener, to write the end of its envelope"""
+
+    def __init__(self, opener, size=WRITER_POOL_SIZE, reopen=False):
+        self.opener, self.size, self.reopen = opener, size, reopen
+        self.writers = OrderedDict()
+        self.keys = set()
+
+    def get(self, key):
+        """Function to return the open writer for key"""
+        writer = self.writers.get(key)
+        if writer is not None:
+            self.writers.move_to_end(key)
+            return writer
+        if len(self.writers) >= self.size:
+            self.writers.popitem(last=False)[1].close()
+        writer = self.writers[key] = self.opener(key, key in self.keys)
+        self.keys.add(key)
+        return writer
+
+    def close(self):
+        if not self.reopen:
+            while self.writers:
+                self.writers.popitem(last=False)[1].close()
+            return
+        closed = self.keys - set(self.writers)
+        while self.writers:
+            self.writers.popitem(last=False)[1].complete()
+        for key in sorted(closed):
+            self.opener(key, True).complete()
+
+
+class SequenceWriter(object):
+    """Class to write encoded records to a sequence of files, as for --max_size
+
+    Files are opened by the function opener(index), which returns a MARCXMLWriter or MARCWriter for the file with that index.
+    A new file is started before writing a record which would take the current file over max_size bytes
+    (including the envelope of the file), or over max_records records; a record is always written to an empty file.
+    If state is given, it is a list [index, size, records] returned by state() for an earlier writer, and writing continues
+    in the file with that index, which is opened by opener(index, True)"""
+
+    def __init__(self, opener, max_size=None, max_records=None, state=None):
+        self.opener, self.max_size, self.max_records = opener, max_size, max_records
+        self.writer, self.index = None, -1
+        if state is None:
+            self.start()
+            return
+        self.index, self.size, self.records = state
+        self.writer = self.opener(self.index, True)
+        self.closing = len(self.writer.envelope()[1])
+
+    def state(self):
+        """Function to return the index of the current file, and the number of bytes and records written to it"""
+        return [self.index, self.size, self.records]
+
+    def start(self):
+        """Function to close the current file and open the next in the sequence"""
+        if self.writer: self.writer.close()
+        self.index += 1
+        self.writer = self.opener(self.index)
+        opening, closing = self.writer.envelope()
+        self.size, self.records, self.closing = len(opening), 0, len(closing)
+
+    def write(self, data):
+        """Function to write a record encoded as bytes, returning True if a new file was started for it"""
+        full = self.records and ((self.max_records and self.records >= self.max_records)
+                                 or (self.max_size and self.size + len(data) + self.closing > self.max_size))
+        if full: self.start()
+        self.writer.write_bytes(data)
+        self.size += len(data)
+        self.records += 1
+        return bool(full)
+
+    def close(self):
+        self.writer.close()
+        self.writer = None
+
+
+class SplitWriter(object):
+    """Class to write records to individual files named by their identifiers, as for --max_size 1
+
+    Records without identifiers are named _NO IDENTIFIER n, where n is the number of the record in the input;
+    records whose names have already been used are given the suffix _DUPLICATE n.
+    Names used in the run are held in memory, and files are created exclusively, so that files which already exist
+    (or are created by another process) are not overwritten but take the next _DUPLICATE name.
+    If subdirs is True, files are placed in subdirectories ab/cd/ of path named from a hash of their names.
+    If ext ends with .gz, .bz2 or .xz, each file is compressed.
+    Files are created in batches of batch_size records"""
+
+    def __init__(self, path, ext, subdirs=False, batch_size=SPLIT_BATCH_SIZE):
+        self.path, self.ext, self.subdirs, self.batch_size = path, ext, subdirs, batch_size
+        self.compression = COMPRESSION.get(split_compression(ext)[1].lower())
+        # Number of duplicates of each name used so far
+        self.names = {}
+        self.directories = {path}
+        self.pending = []
+
+    def write(self, identifier, number, data):
+        """Function to write the data (in bytes) for the record with the given identifier and number in the input"""
+        self.pending.append((identifier or '_NO IDENTIFIER {}'.format(str(number)), data))
+        if len(self.pending) >= self.batch_size: self.flush()
+
+    def directory(self, name):
+        """Function to return the directory for files with the given name"""
+        if not self.subdirs: return self.path
+        digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:4])
+
+    def next_name(self, name):
+        """Function to return the next name for a file for a record with the given name"""
+        count = self.names.get(name, -1) + 1
+        self.names[name] = count
+        if count == 0: return name
+        return '{}_DUPLICATE {}'.format(name, str(count))
+
+    def flush(self):
+        """Function to create the files for the records held in memory"""
+        pending = [(self.directory(name), name, data) for name, data in self.pending]
+        self.pending = []
+        # Files are created directory by directory; the order of records with the same name is kept
+        pending.sort(key=lambda p: p[0])
+        for directory, name, data in pending:
+            if directory not in self.directories:
+                os.makedirs(directory, exist_ok=True)
+                self.directories.add(directory)
+            while True:
+                try:
+                    file = open(os.path.join(directory, self.next_name(name) + self.ext), mode='xb')
+                    break
+                except FileExistsError: continue
+            with file: file.write(self.compression.compress(data) if self.compression else data)
+
+    def close(self):
+        self.flush()
+
+
+class Checkpoint(object):
+    """Class to save the progress of a conversion to a file, so that the conversion can be resumed if it is interrupted
+
+    The state of the conversion is a dictionary, saved as JSON; each save replaces the previous state in a single step.
+    The state also records the length of each output file, after the writers have been flushed and synced to disk,
+    so that anything written after the last save can be removed"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def save(self, state, writers):
+        """Function to save the state of a conversion, with the lengths of the files written by writers {path: writer}"""
+        state = dict(state)
+        state['files'] = {}
+        for path, writer in writers.items():
+            writer.flush()
+            os.fsync(writer.file_handle.fileno())
+            state['files'][path] = writer.file_handle.tell()
+        temp = self.path + '.tmp'
+        with open(temp, mode='w', encoding='utf-8') as file:
+            json.dump(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, self.path)
+
+    def load(self):
+        """Function to return the last state saved, and truncate the output files to their lengths when it was saved"""
+        with open(self.path, mode='r', encoding='utf-8') as file:
+            state = json.load(file)
+        for path, length in state['files'].items():
+            with open(path, mode='r+b') as file: file.truncate(length)
+        return state
+
+    def remove(self):
+        if os.path.exists(self.path): os.remove(self.path)
+
+
+class RecordStore(object):
+    """Class to keep a hash of each record written, by identifier, in an SQLite database, as for --delta
+
+    changed() tells whether a record is new or has changed since the last run; the identifiers seen in this run
+    are noted, so that deleted() can find those which have disappeared.
+    Nothing is saved until commit() is called at the end of a complete run, so an interrupted run leaves the store unchanged"""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS records (identifier TEXT PRIMARY KEY, hash BLOB NOT NULL)')
+        self.connection.execute('CREATE TEMP TABLE seen (identifier TEXT PRIMARY KEY)')
+        self.unchanged = 0
+
+    def seen(self, identifier):
+        """Function to note that the record with identifier is still present, without checking whether it has changed"""
+        self.connection.execute('INSERT OR IGNORE INTO seen VALUES (?)', (identifier,))
+
+    def changed(self, identifier, data):
+        """Function to check whether the data (in bytes) to be written for a record differs from the last run"""
+        digest = hashlib.sha1(data).digest()
+        self.seen(identifier)
+        row = self.connection.execute('SELECT hash FROM records WHERE identifier = ?', (identifier,)).fetchone()
+        if row is not None and row[0] == digest:
+            self.unchanged += 1
+            return False
+        self.connection.execute('INSERT OR REPLACE INTO records VALUES (?, ?)', (identifier, digest))
+        return True
+
+    def deleted(self):
+        """Function to return the identifiers of the records which were not seen in this run, and remove them from the store"""
+        missing = 'FROM records WHERE identifier NOT IN (SELECT identifier FROM temp.seen)'
+        identifiers = [row[0] for row in self.connection.execute('SELECT identifier {} ORDER BY identifier'.format(missing))]
+        self.connection.execute('DELETE {}'.format(missing))
+        return identifiers
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class RecordIndex(object):
+    """Class to find records in a SAMI or MARC file by identifier, using an index saved in the sidecar file <file>.idx
+
+    build() reads the file once, and saves the identifier, byte offset and length of each record, sorted by identifier,
+    as one tab-separated line per record; the first line notes the reader type and the size and modification time
+    of the file, so that an index which is out of date is not used.
+    get() then reads a single record without scanning the file, and ranges() divides the file into byte ranges
+    starting at records, so that each range can be read by a separate reader positioned with seek(start, end).
+    reader_type is one of the types accepted by sami_factory(), or 'marc' for MARC exchange files;
+    compressed files cannot be indexed, as they cannot be read from an offset"""
+
+    def __init__(self, path, reader_type):
+        self.path, self.reader_type = path, reader_type
+        self.index_path = path + INDEX_EXTENSION
+        self.identifiers, self.offsets, self.lengths = [], [], []
+        self._reader = None
+
+    def reader(self):
+        """Function to return a new reader for the file"""
+        if self.reader_type == 'marc': return MARCReader(self.path)
+        return sami_factory(self.reader_type, self.path)
+
+    def _signature(self):
+        status = os.stat(self.path)
+        return '\t'.join([INDEX_VERSION, self.reader_type, str(status.st_size), str(status.st_mtime_ns)])
+
+    def build(self):
+        """Function to read the file and save its index, returning the number of records indexed
+
+        Records without identifiers are not indexed"""
+        reader = self.reader()
+        items = reader if self.reader_type == 'marc' else reader.chunks()
+        entries = []
+        for item in items:
+            identifier = reader.identifier(item)
+            # Identifiers are stored with their whitespace normalised, so that they cannot break the lines of the index
+            if identifier: identifier = ' '.join(identifier.split())
+            if identifier: entries.append((identifier, reader.record_start, reader.offset - reader.record_start))
+        reader.close()
+        entries.sort()
+        temp = self.index_path + '.tmp'
+        with open(temp, mode='w', encoding='utf-8', newline='\n') as file:
+            file.write(self._signature() + '\n')
+            for entry in entries: file.write('{}\t{}\t{}\n'.format(*entry))
+        os.replace(temp, self.index_path)
+        self.identifiers, self.offsets, self.lengths = [e[0] for e in entries], [e[1] for e in entries], [e[2] for e in entries]
+        return len(entries)
+
+    def load(self):
+        """Function to read the index saved by build(), returning the number of records indexed
+
+        IndexFileError is raised if the index does not exist, or the file has changed since it was built"""
+        try:
+            with open(self.index_path, mode='r', encoding='utf-8', newline='\n') as file:
+                if file.readline().rstrip('\n') != self._signature(): raise IndexFileError(self.index_path)
+                identifiers, offsets, lengths = [], [], []
+                for line in file:
+                    identifier, offset, length = line.rstrip('\n').split('\t')
+                    identifiers.append(identifier)
+                    offsets.append(int(offset))
+                    lengths.append(int(length))
+        except (OSError, ValueError): raise IndexFileError(self.index_path)
+        self.identifiers, self.offsets, self.lengths = identifiers, offsets, lengths
+        return len(identifiers)
+
+    def get(self, identifier):
+        """Function to return the first record in the file with identifier, or None if there is no such record"""
+        identifier = ' '.join(str(identifier).split())
+        i = bisect_left(self.identifiers, identifier)
+        if i == len(self.identifiers) or self.identifiers[i] != identifier: return None
+        if self._reader is None: self._reader = self.reader()
+        return self._reader.read_record(self.offsets[i], self.lengths[i])
+
+    def ranges(self, parts):
+        """Function to divide the file into at most parts byte ranges (start, end) of similar size, each starting at a record
+
+        The end of the last range is None"""
+        starts = sorted(self.offsets)
+        size = os.path.getsize(self.path)
+        bounds = [0]
+        for n in range(1, parts):
+            i = bisect_left(starts, size * n // parts)
+            if i < len(starts) and starts[i] > bounds[-1]: bounds.append(starts[i])
+        return list(zip(bounds, bounds[1:] + [None]))
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
 
 
 class MARCRecord(object):
+
+    __slots__ = ('leader', 'fields', 'pos', '_marc', '_xml', '_keys', '_ordered', '_index', '_indexed')
+
     def __init__(self, data='', leader=' ' * LEADER_LENGTH):
         self.leader = '{}22{}4500'.format(leader[0:10], leader[12:20])
         self.fields = list()
         self.pos = 0
+        # Cached encodings of the record, cleared whenever its fields change
+        self._marc, self._xml = None, {}
+        # Sort keys of the fields for ordered insertion, and whether the keys are in ascending order
+        self._keys, self._ordered = None, True
+        # Index of the fields by upper-case tag, in record order, and the number of fields indexed
+        self._index, self._indexed = None, 0
         if len(data) > 0: self.decode_marc(data)
 
     def __getitem__(self, tag):
-        fields = self.get_fields(tag)
-        if len(fields) > 0: return fields[0]
+        fields = self._tag_index().get(tag)
+        if fields: return fields[0]
         return None
 
     def __contains__(self, tag):
-        fields = self.get_fields(tag)
-        return len(fields) > 0
+        return tag in self._tag_index()
 
     def __iter__(self):
-        self.__pos = 0
-        return self
-
-    def __next__(self):
-        if self.__pos >= len(self.fields): raise StopIteration
-        self.__pos += 1
-        return self.fields[self.__pos - 1]
+        return iter(self.fields)
 
     def __str__(self):
-        fields, directory = b'', b''
-        offset = 0
-
-        for field in self.fields:
-            field_data = field.as_marc()
-            fields += field_data
-            if field.tag.isdigit():
-                directory += ('%03d' % int(field.tag)).encode('utf-8')
-            else:
-                directory += ('%03s' % field.tag).encode('utf-8')
-            directory += ('%04d%05d' % (len(field_data), offset)).encode('utf-8')
-            offset += len(field_data)
-
-        directory += END_OF_FIELD.encode('utf-8')
-        fields += END_OF_RECORD.encode('utf-8')
-        base_address = LEADER_LENGTH + len(directory)
-        record_length = base_address + len(fields)
-        leader = '%05d%s%05d%s' % (record_length, self.leader[5:12], base_address, self.leader[17:])
-
-        text_list = ['=LDR  {}'.format(leader)]
+        text_list = ['=LDR  {}'.format(self.marc_leader())]
         text_list.extend([str(field) for field in self.fields])
         return '\n'.join(text_list) + '\n'
 
+    def invalidate(self):
+        """Clears the cached encodings of the record; must be called after changing fields or leader directly"""
+        self._clear_cache()
+        self._keys, self._index = None, None
+
+    def _clear_cache(self):
+        self._marc, self._xml = None, {}
+
     def add_field(self, *fields):
-        self.fields.extend(fields)
+        self._clear_cache()
+        keys = self._field_keys()
+        for f in fields:
+            f._owner = self
+            self.fields.append(f)
+            self._append_key(keys, f.tag)
+            self._index_field(f)
 
     def add_ordered_field(self, *fields):
+        self._clear_cache()
+        keys = self._field_keys()
         for f in fields:
+            f._owner = self
             if len(self.fields) == 0 or not f.tag.isdigit():
                 self.fields.append(f)
+                self._append_key(keys, f.tag)
+                self._index_field(f)
                 continue
             self._sort_fields(f)
 
-    def _sort_fields(self, field):
-        tag = int(field.tag)
+    @staticmethod
+    def _sort_key(tag, last_key):
+        """Function to return the key of a field for ordered insertion
 
-        i, last_tag = 0, 0
-        for selff in self.fields:
-            i += 1
-            if not selff.tag.isdigit() and selff.tag not in ALEPH_CONTROL_FIELDS:
-                self.fields.insert(i - 1, field)
-                break
+        A new field is inserted before the first field with a greater key;
+        fields with non-numeric tags end the ordered fields, and ALEPH control fields take the key of the field before"""
+        if tag in ALEPH_CONTROL_FIELDS: return last_key
+        if not tag.isdigit(): return float('inf')
+        return int(tag)
 
-            if selff.tag not in ALEPH_CONTROL_FIELDS:
-                last_tag = int(selff.tag)
+    def _field_keys(self):
+        """Function to return the sort keys of the fields, rebuilding them if the fields have been changed directly"""
+        if self._keys is None or len(self._keys) != len(self.fields):
+            self._keys, self._ordered = [], True
+            for f in self.fields: self._append_key(self._keys, f.tag)
+        return self._keys
 
-            if last_tag > tag:
-                self.fields.insert(i - 1, field)
-                break
-            if len(self.fields) == i:
-                self.fields.append(field)
-                break
+    def _append_key(self, keys, tag):
+        key = self._sort_key(tag, keys[-1] if keys else 0)
+        if keys and key < keys[-1]: self._ordered = False
+        keys.append(key)
+
+    def _sort_fields(self, field):
+        tag = int(field.tag)
+        keys = self._field_keys()
+        if self._ordered: i = bisect_right(keys, tag)
+        else: i = next((i for i, key in enumerate(keys) if key > tag), len(keys))
+        self.fields.insert(i, field)
+        keys.insert(i, tag)
+        # Fields with the same tag all precede the insertion point only if the keys are ascending
+        if self._ordered: self._index_field(field)
+        else: self._index = None
+
+    def _tag_index(self):
+        """Function to return the index of the fields by tag, rebuilding it if the fields have been changed directly"""
+        if self._index is None or self._indexed != len(self.fields):
+            self._index, self._indexed = {}, len(self.fields)
+            for f in self.fields: self._index.setdefault(f.tag.upper(), []).append(f)
+        return self._index
+
+    def _index_field(self, field):
+        if self._index is None: return
+        self._index.setdefault(field.tag.upper(), []).append(field)
+        self._indexed += 1
 
     def get_fields(self, *args):
         if len(args) == 0: return self.fields
+        if len(args) == 1: return list(self._tag_index().get(args[0], []))
         return [f for f in self.fields if f.tag.upper() in args]
 
     def decode_marc(self, marc):
+        """Function to read the record from MARC exchange format
+
+        marc may be bytes or a memoryview; fields keep a view of their data, and are decoded when first used"""
         # Extract record leader
         try:
-            self.leader = marc[0:LEADER_LENGTH].decode('ascii')
+            self.leader = str(marc[0:LEADER_LENGTH], 'ascii')
         except:
             print('Record has problem with Leader and cannot be processed')
         if len(self.leader) != LEADER_LENGTH: raise LeaderError
@@ -545,74 +1736,46 @@ class MARCRecord(object):
         self.leader = self.leader[0:9] + 'a' + self.leader[10:]
 
         # Extract the byte offset where the record data starts
-        base_address = int(marc[12:17])
+        base_address = int(bytes(marc[12:17]))
         if base_address <= 0: raise BaseAddressError
         if base_address >= len(marc): raise BaseAddressLengthError
 
         # Extract directory
         # base_address-1 is used since the directory ends with an END_OF_FIELD byte
-        directory = marc[LEADER_LENGTH:base_address - 1].decode('ascii')
+        directory = str(marc[LEADER_LENGTH:base_address - 1], 'ascii')
 
         # Determine the number of fields in record
         if len(directory) % DIRECTORY_ENTRY_LENGTH != 0:
             raise DirectoryError
-        field_total = len(directory) / DIRECTORY_ENTRY_LENGTH
 
         # Add fields to record using directory offsets
-        field_count = 0
-        while field_count < field_total:
-            entry_start = field_count * DIRECTORY_ENTRY_LENGTH
-            entry_end = entry_start + DIRECTORY_ENTRY_LENGTH
-            entry = directory[entry_start:entry_end]
+        # The fields are added together; their sort keys and tag index are built when first needed
+        fields = []
+        for entry_start in range(0, len(directory), DIRECTORY_ENTRY_LENGTH):
+            entry = directory[entry_start:entry_start + DIRECTORY_ENTRY_LENGTH]
             entry_tag = entry[0:3]
             entry_length = int(entry[3:7])
-            entry_offset = int(entry[7:12])
-            entry_data = marc[base_address + entry_offset:base_address + entry_offset + entry_length - 1]
-
-            # Check if tag is a control field
-            if str(entry_tag) < '010' and entry_tag.isdigit():
-                field = Field(tag=entry_tag, data=entry_data.decode('utf-8'))
-            elif str(entry_tag) in ALEPH_CONTROL_FIELDS:
-                field = Field(tag=entry_tag, data=entry_data.decode('utf-8'))
-
-            else:
-                subfields = list()
-                subs = entry_data.split(SUBFIELD_INDICATOR.encode('ascii'))
-                # Missing indicators are recorded as blank spaces.
-                # Extra indicators are ignored.
-
-                subs[0] = subs[0].decode('ascii') + '  '
-                first_indicator, second_indicator = subs[0][0], subs[0][1]
-
-                for subfield in subs[1:]:
-                    if len(subfield) == 0: continue
-                    try:
-                        code, data = subfield[0:1].decode('ascii'), subfield[1:].decode('utf-8', 'strict')
-                        subfields.append(code)
-                        subfields.append(data)
-                    except:
-                        print('Error in subfield code in field {}'.format(entry_tag))
-                field = Field(
-                    tag=entry_tag,
-                    indicators=[first_indicator, second_indicator],
-                    subfields=subfields,
-                )
-            self.add_field(field)
-            field_count += 1
+            entry_offset = base_address + int(entry[7:12])
+            field = Field.from_marc(entry_tag, marc[entry_offset:entry_offset + entry_length - 1])
+            field._owner = self
+            fields.append(field)
 
-        if field_count == 0: raise FieldsError
+        if len(fields) == 0: raise FieldsError
+        self.fields.extend(fields)
+        self._clear_cache()
 
     def as_marc(self):
+        if self._marc is None: self._marc = self._as_marc()
+        return self._marc
+
+    def _as_marc(self):
         fields, directory = b'', b''
         offset = 0
 
         for field in self.fields:
             field_data = field.as_marc()
             fields += field_data
-            if field.tag.isdigit():
-                directory += ('%03d' % int(field.tag)).encode('utf-8')
-            else:
-                directory += ('%03s' % field.tag).encode('utf-8')
+            directory += field.directory_tag()
             directory += ('%04d%05d' % (len(field_data), offset)).encode('utf-8')
             offset += len(field_data)
 
@@ -624,34 +1787,39 @@ class MARCRecord(object):
         leader = strleader.encode('utf-8')
         return leader + directory + fields
 
-    def as_xml(self, namespace=False):
-        if namespace:
-            xml = '\n\t<marc:record xsi:schemaLocation="http://www.loc.gov/MARC21/slim http://www.loc.gov/standards/marcxml/schema/MARC21slim.xsd">'
-        else: xml = '\n\t<marc:record>'
-        fields, directory = b'', b''
-        offset = 0
+    def marc_leader(self):
+        """Function to return the leader of the record in MARC exchange format
+
+        Lengths are calculated from the lengths of the fields, without building the directory"""
+        directory_length, offset = 0, 0
         for field in self.fields:
-            field_data = field.as_marc()
-            fields += field_data
-            if field.tag.isdigit():
-                directory += ('%03d' % int(field.tag)).encode('utf-8')
-            else:
-                directory += ('%03s' % field.tag).encode('utf-8')
-            directory += ('%04d%05d' % (len(field_data), offset)).encode('utf-8')
-            offset += len(field_data)
-        directory += END_OF_FIELD.encode('utf-8')
-        fields += END_OF_RECORD.encode('utf-8')
-        base_address = LEADER_LENGTH + len(directory)
-        record_length = base_address + len(fields)
-        leader = '%05d%s%05d%s' % (record_length, self.leader[5:12], base_address, self.leader[17:])
-        xml += '\n\t\t<marc:leader>{}</marc:leader>'.format(leader)
+            length = field.marc_length()
+            # Entries for oversized fields or records overflow their width, as in as_marc()
+            directory_length += len(field.directory_tag()) + len('%04d%05d' % (length, offset))
+            offset += length
+        base_address = LEADER_LENGTH + directory_length + 1
+        record_length = base_address + offset + 1
+        return '%05d%s%05d%s' % (record_length, self.leader[5:12], base_address, self.leader[17:])
+
+    def as_xml(self, namespace=False):
+        if namespace not in self._xml: self._xml[namespace] = self._as_xml(namespace)
+        return self._xml[namespace]
+
+    def _as_xml(self, namespace=False):
+        xml = [XML_RECORD_NS if namespace else XML_RECORD, XML_LEADER.format(self.marc_leader())]
         for field in self.fields:
-            xml += '\n' + field.as_xml()
-        return xml + '\n\t</marc:record>'
+            xml.append('\n')
+            xml.append(field.as_xml())
+        xml.append('\n\t</marc:record>')
+        return ''.join(xml)
 
 
 class Field(object):
 
+    # Subfields are held as a flat tuple (code, value, code, value, ...);
+    # data, indicators and subfields are set through properties, which clear the cached encodings of the record
+    __slots__ = ('tag', '_data', '_indicator1', '_indicator2', '_subfields', '_owner', '_raw')
+
     def __init__(self, tag, indicators=None, subfields=None, data=''):
         if indicators is None: indicators = []
         if subfields is None: subfields = []
@@ -660,18 +1828,110 @@ class Field(object):
         # Normalize tag to three digits
         self.tag = '%03s' % tag
 
+        # Record to which the field belongs, whose cached encodings must be cleared when the field changes
+        self._owner = None
+
+        # Data of a field read from MARC exchange format, which has not yet been decoded
+        self._raw = None
+
         # Check if tag is a control field
         if self.tag < '010' and self.tag.isdigit():
-            self.data = str(data)
+            self._data = str(data)
         elif self.tag in ALEPH_CONTROL_FIELDS:
-            self.data = str(data)
+            self._data = str(data)
         else:
-            self.indicator1, self.indicator2 = self.indicators = indicators
+            self._indicator1, self._indicator2 = indicators
             self.subfields = subfields
 
+    @classmethod
+    def from_marc(cls, tag, raw):
+        """Function to create a field from its data in MARC exchange format, which is decoded when first used"""
+        field = cls.__new__(cls)
+        field.tag, field._owner, field._raw = '%03s' % tag, None, raw
+        return field
+
+    def __getattr__(self, name):
+        # Only called for attributes which have not been set, so fields which have been decoded are unaffected
+        if name == '_raw' or name not in Field.__slots__ or self._raw is None: raise AttributeError(name)
+        self._decode_marc()
+        return object.__getattribute__(self, name)
+
+    def _decode_marc(self):
+        raw, self._raw = bytes(self._raw), None
+        if self.is_control_field():
+            self._data = raw.decode('utf-8')
+            return
+        subfields = list()
+        subs = raw.split(SUBFIELD_INDICATOR.encode('ascii'))
+        # Missing indicators are recorded as blank spaces.
+        # Extra indicators are ignored.
+
+        subs[0] = subs[0].decode('ascii') + '  '
+        self._indicator1, self._indicator2 = subs[0][0], subs[0][1]
+
+        for subfield in subs[1:]:
+            if len(subfield) == 0: continue
+            try:
+                code, data = subfield[0:1].decode('ascii'), subfield[1:].decode('utf-8', 'strict')
+                subfields.append(code)
+                subfields.append(data)
+            except:
+                print('Error in subfield code in field {}'.format(self.tag))
+        self._subfields = tuple(subfields)
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        if self._owner: self._owner._clear_cache()
+
+    @property
+    def indicator1(self):
+        return self._indicator1
+
+    @indicator1.setter
+    def indicator1(self, indicator):
+        self._indicator1 = indicator
+        if self._owner: self._owner._clear_cache()
+
+    @property
+    def indicator2(self):
+        return self._indicator2
+
+    @indicator2.setter
+    def indicator2(self, indicator):
+        self._indicator2 = indicator
+        if self._owner: self._owner._clear_cache()
+
+    @property
+    def indicators(self):
+        return [self._indicator1, self._indicator2]
+
+    @indicators.setter
+    def indicators(self, indicators):
+        self._indicator1, self._indicator2 = indicators
+        if self._owner: self._owner._clear_cache()
+
+    @property
+    def subfields(self):
+        """Subfield codes and values of the field, as a flat tuple (code, value, code, value, ...)
+
+        The tuple cannot be changed in place; subfields are changed by assigning to subfields or with add_subfield()"""
+        return self._subfields
+
+    @subfields.setter
+    def subfields(self, subfields):
+        if len(subfields) % 2: raise ValueError('Subfield code {!r} in field {} has no value'.format(subfields[-1], self.tag))
+        self._subfields = tuple(subfields)
+        if self._owner: self._owner._clear_cache()
+
     def __iter__(self):
-        self.__pos = 0
-        return self
+        """Returns a new iterator over the (code, value) pairs of the field"""
+        subfields = iter(getattr(self, '_subfields', ()))
+        return zip(subfields, subfields)
 
     def __getitem__(self, subfield):
         subfields = self.get_subfields(subfield)
@@ -682,15 +1942,6 @@ class Field(object):
         subfields = self.get_subfields(subfield)
         return len(subfields) > 0
 
-    def __next__(self):
-        if not hasattr(self, 'subfields'):
-            raise StopIteration
-        while self.__pos + 1 < len(self.subfields):
-            subfield = (self.subfields[self.__pos], self.subfields[self.__pos + 1])
-            self.__pos += 2
-            return subfield
-        raise StopIteration
-
     def __str__(self):
         if self.is_control_field() or self.tag in ALEPH_CONTROL_FIELDS:
             text = '={}  {}'.format(self.tag, self.data.replace(' ', '#'))
@@ -706,15 +1957,11 @@ class Field(object):
 
     def get_subfields(self, *codes):
         """Accepts one or more subfield codes and returns a list of subfield values"""
-        values = []
-        for subfield in self:
-            if len(codes) == 0 or subfield[0] in codes:
-                values.append(str(subfield[1]))
-        return values
+        return [str(value) for code, value in self if len(codes) == 0 or code in codes]
 
     def add_subfield(self, code, value):
-        self.subfields.append(code)
-        self.subfields.append(clean_text(value))
+        self._subfields += (code, clean_text(value))
+        if self._owner: self._owner._clear_cache()
 
     def is_control_field(self):
         if self.tag < '010' and self.tag.isdigit(): return True
@@ -723,16 +1970,29 @@ class Field(object):
 
     def as_marc(self):
         if self.is_control_field():
-            return (self.data + END_OF_FIELD).encode('utf-8')
-        marc = self.indicator1 + self.indicator2
-        for subfield in self:
-            marc += SUBFIELD_INDICATOR + subfield[0] + subfield[1]
-        return (marc + END_OF_FIELD).encode('utf-8')
+            return (self._data + END_OF_FIELD).encode('utf-8')
+        marc = [self._indicator1, self._indicator2]
+        for code, value in self:
+            marc.extend((SUBFIELD_INDICATOR, code, value))
+        marc.append(END_OF_FIELD)
+        return ''.join(marc).encode('utf-8')
+
+    def directory_tag(self):
+        """Function to return the tag of the field as it appears in the record directory"""
+        if self.tag.isdigit(): return ('%03d' % int(self.tag)).encode('utf-8')
+        return ('%03s' % self.tag).encode('utf-8')
+
+    def marc_length(self):
+        """Function to return the length in bytes of the field in MARC exchange format"""
+        if self.is_control_field():
+            return len(self._data.encode('utf-8')) + 1
+        return len(''.join((self._indicator1, self._indicator2) + self._subfields).encode('utf-8')) + len(self._subfields) // 2 + 1
 
     def as_xml(self):
         if self.is_control_field():
-            return '\t\t<marc:controlfield tag="{}">{}</marc:controlfield>'.format(self.tag, clean_text(self.data))
-        xml = '\t\t<marc:datafield tag="{}" ind1="{}" ind2="{}">'.format(self.tag, self.indicator1, self.indicator2)
-        for subfield in self:
-            xml += '\n\t\t\t<marc:subfield code="{}">{}</marc:subfield>'.format(subfield[0], clean_text(subfield[1].strip()))
-        return xml + '\n\t\t</marc:datafield>'
\ No newline at end of file
+            return XML_CONTROLFIELD.format(self.tag, clean_text(self._data))
+        xml = [XML_DATAFIELD.format(self.tag, self._indicator1, self._indicator2)]
+        xml.extend(XML_SUBFIELD.format(code, clean_text(value.strip()))
+                   for code, value in self)
+        xml.append('\n\t\t</marc:datafield>')
+        return ''.join(xml)
\ No newline at end of file
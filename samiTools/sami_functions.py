@@ -3,19 +3,33 @@
 """Functions used within samiTools."""
 
 # Import required modules
+from bisect import bisect_left, bisect_right
+import bz2
+import codecs
 from collections import OrderedDict
 import datetime
 import fileinput
+from functools import lru_cache
 import gc
 import getopt
+import gzip
+import hashlib
 import html
+import io
+import json
 import locale
+import lzma
+import mmap
 import os
+import queue
 import re
+import sqlite3
 import string
 import sys
 import textwrap
+import threading
 import unicodedata
+from xml.parsers import expat
 
 __author__ = 'Victoria Morris'
 __license__ = 'MIT License'
@@ -31,6 +45,20 @@ __status__ = '4 - Beta Development'
 SAMI_SUFFICES = ('export_ALL', 'export_DOCRECITEM', 'export_MLRECITEM', 'export_PUBLPROD', 'export_WORK', 'export_WRSECITEM')
 PRIMO_FLAGS = ('primo_dels', 'primo_upd')
 
+# Characters which are changed by clean_text(): entities, HTML special characters, and C0 and C1 control characters
+UNCLEAN_TEXT = re.compile(r'[&<>"\'\u0000-\u001F\u007F-\u009F]')
+CONTROL_CHARACTERS = dict.fromkeys(list(range(0x00, 0x20)) + list(range(0x7F, 0xA0)))
+CLEAN_TEXT_CACHE_SIZE = 4096
+# Number of distinct date strings remembered by parse_date()
+DATE_CACHE_SIZE = 16384
+
+# Modules used to read and write files with each compressed file extension
+COMPRESSION = OrderedDict([('.gz', gzip), ('.bz2', bz2), ('.xz', lzma)])
+# Size of the blocks passed between the main thread and the thread (de)compressing a file,
+# and the number of blocks which may be waiting
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+COMPRESSION_QUEUE_SIZE = 8
+
 
 # ====================
 #       Classes
@@ -43,7 +71,7 @@ class FilePath:
     def __init__(self, path=None, function='input'):
         self.path = None
         self.function = function
-        self.folder, self.filename, self.ext = '', '', ''
+        self.folder, self.filename, self.ext, self.compression = '', '', '', ''
         self.file_object = None
         self.file_writer = None
         if path: self.set_path(path)
@@ -54,21 +82,158 @@ class FilePath:
         if not path or path == '':
             exit_prompt('Error: Could not parse path to {} file'.format(self.function))
         try:
-            self.filename, self.ext = os.path.splitext(os.path.basename(path))
+            name, self.compression = split_compression(os.path.basename(path))
+            self.filename, self.ext = os.path.splitext(name)
             self.folder = os.path.dirname(path)
         except:
             exit_prompt('Error: Could not parse path to {} file'.format(self.function))
         if self.ext not in expected_ext:
-            exit_prompt('Error: The specified file should have the extension {}'.format(' or '.join(expected_ext)))
-        if 'output' not in self.function and not os.path.isfile(os.path.join(self.folder, self.filename + self.ext)):
+            exit_prompt('Error: The specified file should have the extension {}, optionally followed by {}'.format(
+                ' or '.join(expected_ext), ' or '.join(COMPRESSION)))
+        if 'output' not in self.function and not os.path.isfile(path):
             exit_prompt('Error: The specified {} file cannot be found'.format(self.function))
 
 
+class ThreadedReader(io.BufferedIOBase):
+    """Class to read a binary file in a background thread, so that reading (and decompressing) it overlaps with processing
+
+    The file is read in blocks of block_size bytes, of which at most COMPRESSION_QUEUE_SIZE are held in memory"""
+
+    def __init__(self, file_handle, name=None, block_size=COMPRESSION_BLOCK_SIZE):
+        self.file_handle, self.name, self.block_size = file_handle, name, block_size
+        self.queue = queue.Queue(COMPRESSION_QUEUE_SIZE)
+        self._block, self._pos, self._eof = b'', 0, False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        try:
+            while not self._stop.is_set():
+                block = self.file_handle.read(self.block_size)
+                self.queue.put(block)
+                if not block: return
+        except Exception as err: self.queue.put(err)
+
+    def _next_block(self):
+        """Function to wait for the next block read by the thread, returning False at the end of the file"""
+        if self._eof: return False
+        block = self.queue.get()
+        if isinstance(block, Exception):
+            self._eof = True
+            raise block
+        if not block: self._eof = True
+        self._block, self._pos = block, 0
+        return bool(block)
+
+    def readable(self):
+        return True
+
+    def read1(self, size=-1):
+        if self._pos >= len(self._block) and not self._next_block(): return b''
+        end = len(self._block) if size is None or size < 0 else self._pos + size
+        data = self._block[self._pos:end]
+        self._pos += len(data)
+        return data
+
+    def read(self, size=-1):
+        if size is None: size = -1
+        parts = []
+        while size:
+            data = self.read1(size)
+            if not data: break
+            parts.append(data)
+            if size > 0: size -= len(data)
+        return b''.join(parts)
+
+    def close(self):
+        if self.closed: return
+        # Blocks waiting to be read are discarded, so that the thread can finish
+        self._stop.set()
+        while self._thread.is_alive():
+            try: self.queue.get(timeout=0.1)
+            except queue.Empty: pass
+        self.file_handle.close()
+        super().close()
+
+
+class ThreadedWriter(io.BufferedIOBase):
+    """Class to write to a binary file in a background thread, so that (compressing and) writing it overlaps with processing
+
+    Data is passed to the thread in the blocks received by write(), of which at most COMPRESSION_QUEUE_SIZE are held in memory;
+    an error writing the file is raised by the next call to write(), flush() or close()"""
+
+    def __init__(self, file_handle, name=None):
+        self.file_handle, self.name = file_handle, name
+        self.queue = queue.Queue(COMPRESSION_QUEUE_SIZE)
+        self.error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            data = self.queue.get()
+            try:
+                if data is None: return
+                if self.error is None: self.file_handle.write(data)
+            except Exception as err: self.error = err
+            finally: self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None: raise self.error
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._check()
+        # Data is copied, as the caller may reuse its buffer
+        self.queue.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        """Function to wait until all data received has been written to the file"""
+        self.queue.join()
+        self._check()
+        self.file_handle.flush()
+
+    def close(self):
+        if self.closed: return
+        self.queue.put(None)
+        self._thread.join()
+        try: super().close()
+        finally: self.file_handle.close()
+        self._check()
+
+
 # ====================
 #  General Functions
 # ====================
 
 
+def split_compression(path):
+    """Function to split the extension of a compressed file (.gz, .bz2 or .xz) from its path
+
+    Returns a tuple (path, extension), where extension is '' if the file is not compressed"""
+    root, ext = os.path.splitext(path)
+    if ext.lower() in COMPRESSION: return root, ext
+    return path, ''
+
+
+def open_compressed(path, mode='r', encoding=None, errors=None):
+    """Function to open a file, which is read or written with gzip, bzip2 or xz compression if it has the extension
+    .gz, .bz2 or .xz
+
+    Compressed files are read or written by a background thread, and are always opened in binary mode
+    for writing; mode may be 'r', 'rb', 'wb', 'ab' or 'xb'"""
+    module = COMPRESSION.get(split_compression(path)[1].lower())
+    if module is None: return open(path, mode=mode, encoding=encoding, errors=errors)
+    if 'r' not in mode: return ThreadedWriter(module.open(path, mode=mode), name=path)
+    stream = ThreadedReader(module.open(path, mode='rb'), name=path)
+    if 'b' in mode: return stream
+    return io.TextIOWrapper(stream, encoding=encoding, errors=errors)
+
+
 def print_opt(o, v, indent=5):
     """Function to print information about options/arguments for a function"""
     print('{}{:<10}  {:<40}'.format(' ' * indent, o, textwrap.fill(v, width=60 - indent, subsequent_indent=' ' * (indent + 12))))
@@ -87,6 +252,16 @@ def date_time_exit():
     sys.exit()
 
 
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(s, fmt='%d/%m/%Y'):
+    """Function to convert a date in the given format to yyyymmdd format
+
+    Returns a tuple (yyyymmdd, key), where key is the date as an integer which sorts in date order;
+    raises ValueError if the date cannot be parsed"""
+    d = datetime.datetime.strptime(s, fmt)
+    return d.strftime('%Y%m%d'), d.year * 10000 + d.month * 100 + d.day
+
+
 def exit_prompt(message=None):
     """Function to exit the program after prompting the use to press Enter"""
     if message: print(str(message))
@@ -103,4 +278,10 @@ def exit_prompt(message=None):
 def clean_text(s):
     """Function to remove control characters and escape invalid HTML characters <>&"""
     if s is None or not s: return None
-    return html.escape(re.sub(r'[\u0000-\u001F\u007F-\u009F]', '', html.unescape(s)))
\ No newline at end of file
+    if not UNCLEAN_TEXT.search(s): return s
+    return _clean_text(s)
+
+
+@lru_cache(maxsize=CLEAN_TEXT_CACHE_SIZE)
+def _clean_text(s):
+    return html.escape(html.unescape(s).translate(CONTROL_CHARACTERS))
\ No newline at end of file
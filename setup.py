@@ -31,6 +31,7 @@ setup(
     console=[
         'bin/sami2marc_products.py',
         'bin/sami2marc_authorities.py',
+        'bin/sami_extract.py',
     ],
     zipfile=None,
     options={
@@ -49,6 +50,7 @@ setup(
     scripts=[
         'bin/sami2marc_products.py',
         'bin/sami2marc_authorities.py',
+        'bin/sami_extract.py',
     ],
     classifiers=[
         'Development Status :: 4 - Beta',
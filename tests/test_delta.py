@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Regression tests for converting SAMI Authorities with --delta"""
+
+# Import required modules
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from samiTools.marc_data import *
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def authorities_record(sid):
+    """Function to return a SAMI Authorities record without an 001, whose identifier is padded as in SAMI exports"""
+    return '{:<16}\t\tNAME\t\tAUTHORIZED\t\t10/12/2009\t\tJCOLLIER  \t\t4/10/1992\t\tIDAVIS    \t\t27/2/2004\t\tLOCAL\t\t\n' \
+           '  100:   |aName {}\n\n'.format(sid, sid)
+
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.folder.name, 'authorities.txt')
+        self.output = os.path.join(self.folder.name, 'out.lex')
+        self.store = os.path.join(self.folder.name, 'store.db')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def convert(self, identifiers):
+        with open(self.input, mode='w', encoding='utf-8') as file:
+            for sid in identifiers: file.write(authorities_record(sid))
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        subprocess.run([sys.executable, os.path.join(ROOT, 'bin', 'sami2marc_authorities.py'), '-i', self.input,
+                        '-o', self.output, '--delta', self.store], env=env, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+    def test_deleted_record_without_001(self):
+        # Records without an 001 are identified by the identifier in their header, without its padding
+        self.convert(['XX1', 'XX2'])
+        self.convert(['XX1'])
+        reader = MARCReader(os.path.join(self.folder.name, 'out_deleted.lex'))
+        deleted = [record['001'].data for record in reader]
+        reader.close()
+        self.assertEqual(deleted, ['XX2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Regression tests for the cached encodings of MARCRecord"""
+
+# Import required modules
+import io
+import unittest
+from samiTools.marc_data import *
+
+
+def build(indicators, data, leader=None):
+    """Function to return a record with a control field and a data field"""
+    record = MARCRecord()
+    if leader: record.leader = leader
+    record.add_field(Field(tag='001', data=data))
+    record.add_field(Field(tag='245', indicators=indicators, subfields=['a', 'Title']))
+    return record
+
+
+class TestMARCRecordCache(unittest.TestCase):
+
+    def check_mutations(self, record):
+        record.as_marc(), record.as_xml()
+        leader = record.leader
+        record['245'].indicators = ['1', '0']
+        self.assertEqual(record.as_marc(), build(['1', '0'], 'A1', leader).as_marc())
+        record['245'].indicator2 = '4'
+        self.assertEqual(record.as_xml(), build(['1', '4'], 'A1', leader).as_xml())
+        record['001'].data = 'B2'
+        self.assertEqual(record.as_marc(), build(['1', '4'], 'B2', leader).as_marc())
+        self.assertEqual(record.as_xml(), build(['1', '4'], 'B2', leader).as_xml())
+
+    def test_built_record(self):
+        self.check_mutations(build([' ', ' '], 'A1'))
+
+    def test_read_record(self):
+        # Fields of records read from MARC exchange format are decoded when first used
+        reader = MARCReader(io.BytesIO(build([' ', ' '], 'A1').as_marc()))
+        self.check_mutations(next(iter(reader)))
+        reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Regression tests for reading MARC XML with SAMIReaderXML"""
+
+# Import required modules
+import os
+import tempfile
+import unittest
+import samiTools.marc_data
+from samiTools.marc_data import *
+
+
+def text_record(n):
+    """Function to return a SAMI text record whose fields are long enough to cross small read blocks"""
+    return '*** DOCUMENT BOUNDARY ***\nFORM=WORK\n.000. |aam  0c a\n.001. |aCKEY{0}\n' \
+           '.245. 10|aDvořák & Björk {0}|b{1}\n.500.   |a{2}\n'.format(n, 'sonata ' * (n % 7), 'Müller <x> ' * (5 + n % 40))
+
+
+class TestSAMIReaderXML(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.block_size = samiTools.marc_data.READ_BLOCK_SIZE
+
+    def tearDown(self):
+        samiTools.marc_data.READ_BLOCK_SIZE = self.block_size
+        self.folder.cleanup()
+
+    def write(self, header):
+        path = os.path.join(self.folder.name, 'records.xml')
+        writer = MARCXMLWriter(open(path, mode='wb'), header=header)
+        for n in range(200):
+            writer.write(SAMIRecordText(text_record(n)))
+        writer.close()
+        return path
+
+    def read(self, path, block_size):
+        samiTools.marc_data.READ_BLOCK_SIZE = block_size
+        reader = sami_factory('xml', path)
+        records = [record.as_marc() for record in reader]
+        reader.close()
+        return records
+
+    def check_block_sizes(self, header):
+        path = self.write(header)
+        expected = self.read(path, self.block_size)
+        self.assertEqual(len(expected), 200)
+        # Field text crosses the boundaries of the blocks in which the input is read
+        for block_size in (97, 4096):
+            self.assertEqual(self.read(path, block_size), expected, 'block size {}'.format(block_size))
+
+    def test_oai_block_sizes(self):
+        self.check_block_sizes(header=True)
+
+    def test_collection_block_sizes(self):
+        self.check_block_sizes(header=False)
+
+    def test_malformed_record(self):
+        # Records after a malformed record are found by searching for boundary lines, without adding empty records
+        path = self.write(header=True)
+        with open(path, mode='r', encoding='utf-8') as file: text = file.read()
+        self.assertIn('Björk 3</marc:subfield>', text)
+        text = text.replace('Björk 3</marc:subfield>', 'Björk 3</marc:subfeld>', 1)
+        with open(path, mode='w', encoding='utf-8') as file: file.write(text)
+        reader = sami_factory('xml', path)
+        identifiers = [record.record['001'].data for record in reader]
+        reader.close()
+        self.assertEqual(identifiers, ['CKEY{}'.format(n) for n in range(200)])
+
+
+if __name__ == '__main__':
+    unittest.main()